@@ -0,0 +1,105 @@
+'''Counts stat calls and time spent adding captured paths to an archive
+
+Compares add_path_to_archive, sharing its symlink memo between calls as the
+Archiver does, with the previous implementation that examined every prefix
+of every path.
+
+    python benchmarks/bench_archive_paths.py [--files N] [--depth D]
+'''
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import os
+import tarfile
+
+from territory import files
+from territory.files import add_path_to_archive
+
+
+def add_path_to_archive_unmemoized(added, archive, path):
+    stk = list(path.parts)
+    i = 1
+    while i <= len(stk):
+        p = Path(*stk[:i])
+        if stk[i-1] == '..':
+            stk[i-2 : i] = []
+            i -= 2
+        elif p.is_symlink():
+            if p not in added:
+                added.add(p)
+                archive.add(p)
+            lp = list(p.readlink().parts)
+            stk[i-1:i] = lp
+            i -= 1
+        elif p not in added:
+            added.add(p)
+            archive.add(p, recursive=False)
+        i += 1
+
+
+def make_tree(root: Path, n_files: int, depth: int) -> list[Path]:
+    '''Creates n_files headers under a deep directory reached through a symlink
+    and returns the paths to them as a compiler would report them'''
+    deep = Path(root, *(f'd{i}' for i in range(depth)))
+    deep.mkdir(parents=True)
+    (root / 'include').symlink_to(deep.relative_to(root), target_is_directory=True)
+    paths = []
+    for i in range(n_files):
+        sub = deep / f's{i % 100}'
+        sub.mkdir(exist_ok=True)
+        (sub / f'h{i}.h').write_text('')
+        paths.append(root / 'include' / f's{i % 100}' / '..' / f's{i % 100}' / f'h{i}.h')
+    return paths
+
+
+class StatCounter:
+    def __init__(self):
+        self.count = 0
+
+    def wrap(self, f):
+        def counted(*args, **kwargs):
+            self.count += 1
+            return f(*args, **kwargs)
+        return counted
+
+
+def measure(name, add, paths):
+    counter = StatCounter()
+    saved = os.stat, os.lstat, files.lstat
+    os.stat, os.lstat, files.lstat = (counter.wrap(f) for f in saved)
+    try:
+        start = perf_counter()
+        with open(os.devnull, 'wb') as devnull, tarfile.open(fileobj=devnull, mode='w|') as tar:
+            add(tar, paths)
+        elapsed = perf_counter() - start
+    finally:
+        os.stat, os.lstat, files.lstat = saved
+    print(f'{name:>12}: {counter.count:>9} stat calls {elapsed:8.3f} s')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--depth', type=int, default=10)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as td:
+        paths = make_tree(Path(td), args.files, args.depth)
+
+        def unmemoized(tar, paths):
+            added = set()
+            for p in paths:
+                add_path_to_archive_unmemoized(added, tar, p)
+
+        def memoized(tar, paths):
+            added, links = set(), {}
+            for p in paths:
+                add_path_to_archive(added, tar, p, links=links)
+
+        measure('unmemoized', unmemoized, paths)
+        measure('memoized', memoized, paths)
+
+
+if __name__ == '__main__':
+    main()
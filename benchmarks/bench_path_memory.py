@@ -0,0 +1,85 @@
+'''Compares memory used to collect the dependencies of a synthetic compilation
+database as path objects and in an interned PathTable
+
+Each variant runs in its own process, receiving the dependencies of every TU
+the way pool workers return them, and keeping the per-TU lists and their
+union as collect_details does.
+
+    python benchmarks/bench_path_memory.py [--tus N] [--deps D] [--headers H]
+'''
+from argparse import ArgumentParser
+from array import array
+from multiprocessing import Process, Queue
+from pathlib import Path
+from random import Random
+from resource import RUSAGE_SELF, getrusage
+from sys import platform
+from time import perf_counter
+import pickle
+
+from territory.paths import PathSet, PathTable, pack_paths, unpack_paths
+
+
+def synthetic_results(tus: int, deps: int, headers: int):
+    '''Yields what a worker sends back for every TU, as path objects'''
+    rng = Random(0)
+    header_paths = [
+        f'/src/project/module{i % 200}/include/{"sub/" * (i % 3)}header{i}.h'
+        for i in range(headers)
+    ] + [f'/usr/include/c++/13/bits/std{i}.h' for i in range(headers // 10)]
+    for tu in range(tus):
+        source = Path(f'/src/project/module{tu % 200}/src/file{tu}.cc')
+        yield {source, *(Path(p) for p in rng.sample(header_paths, deps))}
+
+
+def collect_paths(args):
+    tu_deps = []
+    dep_paths = set()
+    for paths in synthetic_results(*args):
+        paths = pickle.loads(pickle.dumps(paths))
+        tu_deps.append(list(paths))
+        dep_paths.update(paths)
+    return len(dep_paths)
+
+
+def collect_table(args):
+    dep_paths = PathSet(PathTable())
+    tu_deps = []
+    for paths in synthetic_results(*args):
+        blob = pickle.loads(pickle.dumps(pack_paths(paths)))
+        ids = dep_paths.table.intern_all(unpack_paths(blob))
+        dep_paths.add_ids(ids)
+        tu_deps.append(array('I', ids))
+    return len(dep_paths)
+
+
+def peak_rss() -> int:
+    rss = getrusage(RUSAGE_SELF).ru_maxrss
+    return rss if platform == 'darwin' else rss * 1024
+
+
+def measure(collect, args, results):
+    baseline = peak_rss()
+    start = perf_counter()
+    n_paths = collect(args)
+    results.put((n_paths, perf_counter() - start, peak_rss() - baseline))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--tus', type=int, default=100000)
+    parser.add_argument('--deps', type=int, default=50)
+    parser.add_argument('--headers', type=int, default=5000)
+    args = parser.parse_args()
+
+    for name, collect in [('Path sets', collect_paths), ('PathTable', collect_table)]:
+        results = Queue()
+        proc = Process(target=measure, args=(collect, (args.tus, args.deps, args.headers), results))
+        proc.start()
+        n_paths, seconds, rss = results.get()
+        proc.join()
+        print(f'{name:>10}: {n_paths} unique paths, {rss / (1 << 20):8.1f} MiB, {seconds:6.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+'''Times rewriting compilation arguments with the single-pass rule table
+against the previous chain of remove_arg calls
+
+    python benchmarks/bench_rewrite_arguments.py [--flags N] [--commands M]
+'''
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from territory import c
+from territory.c import Vee, remove_arg, split_arguments
+
+
+def chained_rewrite(arguments, vee, dir_):
+    scan = arguments
+    for key, count, prefix in [
+        ('-c', 1, False), ('-M', 1, False), ('-MD', 1, False), ('-MM', 1, False),
+        ('-MMD', 1, False), ('-o', 2, True), ('-MF', 2, True),
+    ]:
+        scan = remove_arg(scan, key, count, prefix=prefix)
+
+    index = arguments[:]
+    index[1:1] = ['-target', vee.target]
+    user_dirs = [a[2:] for a in index if a.startswith('-I')]
+    include_paths = c._merge_include_paths(user_dirs, vee.angle_bracket_include_paths, dir_)
+    for key, count, prefix in [
+        ('-I', 2, True), ('--include-directory', 2, False), ('--include-directory=', 1, True),
+        ('-cxx-isystem', 2, True), ('-ibuiltininc', 1, False), ('-iframework', 2, True),
+        ('-iframeworkwithsysroot', 2, True), ('--stdlib++-isystem', 2, True),
+        ('-isystem', 2, True), ('-M', 1, False), ('-MD', 1, False), ('-MM', 1, False),
+        ('-MMD', 1, False), ('-MF', 2, True),
+    ]:
+        index = remove_arg(index, key, count, prefix=prefix)
+    index[1:1] = ['-nostdinc', *(f'-I{d}' for d in include_paths)]
+    return scan, index
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--flags', type=int, default=2000, help='-I and -D flags per command')
+    parser.add_argument('--commands', type=int, default=500)
+    args = parser.parse_args()
+
+    vee = Vee(target='x86_64-pc-linux-gnu', angle_bracket_include_paths=['/usr/include'])
+    with TemporaryDirectory() as td:
+        commands = [
+            [
+                'clang++',
+                *(f'-I{td}/inc{i}' for i in range(args.flags // 2)),
+                *(f'-DDEF{i}={n}' for i in range(args.flags // 2)),
+                '-MD', '-MF', f'out/f{n}.o.d', '-c', f'src/f{n}.cc', '-o', f'out/f{n}.o',
+            ]
+            for n in range(args.commands)
+        ]
+        for name, rewrite in [('remove_arg chain', chained_rewrite), ('rule table', split_arguments)]:
+            start = perf_counter()
+            for arguments in commands:
+                rewrite(arguments, vee, td)
+            elapsed = perf_counter() - start
+            print(f'{name:>16}: {elapsed:6.2f} s for {args.commands} commands of {len(commands[0])} arguments')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+'''Runs territory upload end to end on synthetic repositories against a local
+stand-in for the upload API, reporting time per phase, peak RSS and bytes
+uploaded, and flagging regressions against a stored baseline
+
+The C repository has TUs including headers through a symlinked include
+directory and through paths full of `..`. Every scenario starts with an empty
+cache, except c-warm which runs again with the cache c left behind. The go
+scenario needs GOSCAN_PATH to point at a goscan binary and is skipped
+otherwise. Requires Flask (pip install '.[test]').
+
+    python benchmarks/bench_upload.py [--tus N] [--headers M] [--scenarios c,c-warm,python]
+        [--baseline FILE] [--save-baseline] [--tolerance T]
+
+Exits with status 1 when a scenario got slower, larger or used more memory
+than the baseline allows. Baselines are only comparable on the same machine
+and with the same parameters; refresh one with --save-baseline.
+'''
+from argparse import ArgumentParser
+from os import environ, wait4, waitstatus_to_exitcode
+from pathlib import Path
+from random import Random
+from shutil import which
+from subprocess import PIPE, Popen, check_call
+from sys import executable, platform
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+import json
+import logging
+
+from flask import Flask, request
+from werkzeug.serving import make_server
+
+
+BASELINE_PATH = Path(__file__).parent / 'baseline_upload.json'
+SCENARIOS = ['c', 'c-warm', 'python', 'go']
+
+# phases after startup begin when the CLI prints their first line; package
+# covers reading commit metadata, scanning and writing the archive
+PHASES = [
+    ('setup', 'repository root directory:'),
+    ('package', 'collecting commit info'),
+    ('register', 'registering build request'),
+    ('upload', 'uploading'),
+]
+
+# differences below these are noise whatever the tolerance
+MIN_SECONDS = 0.25
+MIN_BYTES = 1 << 20
+
+
+def git_commit(repo: Path):
+    check_call(['git', 'init', '-q', '-b', 'main', repo])
+    check_call(['git', '-C', repo, 'add', '.'])
+    check_call([
+        'git', '-C', repo, '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+        'commit', '-q', '-m', 'synthetic repository'])
+
+
+def make_c_repo(root: Path, tus: int, headers: int, includes: int):
+    '''Creates TUs including random headers, some through the inc symlink and
+    some through ../ paths, with a compilation database'''
+    rng = Random(0)
+    real = root / 'include' / 'real'
+    for i in range(headers):
+        header = real / f'sub{i % 20}' / f'h{i}.h'
+        header.parent.mkdir(parents=True, exist_ok=True)
+        header.write_text(''.join(
+            f'int h{i}_f{j}(int a, int b);\n' for j in range(40)))
+    (root / 'inc').symlink_to('include/real', target_is_directory=True)
+
+    compiler = which('clang') or which('cc')
+    commands = []
+    for n in range(tus):
+        source = root / 'src' / f'mod{n % 50}' / f'file{n}.c'
+        source.parent.mkdir(parents=True, exist_ok=True)
+        lines = ['#include <stddef.h>\n']
+        for i in rng.sample(range(headers), min(includes, headers)):
+            if i % 3 == 0:
+                lines.append(f'#include "../../include/real/sub{i % 20}/../sub{i % 20}/h{i}.h"\n')
+            else:
+                lines.append(f'#include "sub{i % 20}/h{i}.h"\n')
+        lines.append(f'int file{n}(void) {{ return {n}; }}\n')
+        source.write_text(''.join(lines))
+        commands.append({
+            'directory': str(root),
+            'file': str(source.relative_to(root)),
+            'arguments': [
+                compiler, '-Iinc', '-Iinc/sub0/..', '-c',
+                '-o', f'file{n}.o', str(source.relative_to(root))],
+        })
+    (root / 'compile_commands.json').write_text(json.dumps(commands, indent=1))
+    git_commit(root)
+
+
+def make_python_repo(root: Path, modules: int):
+    for n in range(modules):
+        module = root / f'pkg{n % 50}' / f'mod{n}.py'
+        module.parent.mkdir(parents=True, exist_ok=True)
+        (module.parent / '__init__.py').touch()
+        other = (n * 7 + 1) % modules
+        module.write_text(
+            f'from pkg{other % 50}.mod{other} import f{other}_0\n\n' +
+            ''.join(
+                f'def f{n}_{j}(a, b):\n    return f{other}_0(a, b) + {j}\n\n'
+                for j in range(20)))
+    git_commit(root)
+
+
+def make_go_repo(root: Path, packages: int, files: int):
+    root.mkdir(parents=True, exist_ok=True)
+    (root / 'go.mod').write_text('module example.com/bench\n\ngo 1.21\n')
+    for p in range(packages):
+        other = (p + 1) % packages
+        for n in range(files):
+            source = root / f'pkg{p}' / f'file{n}.go'
+            source.parent.mkdir(exist_ok=True)
+            uses_other = n == 0 and other > p
+            source.write_text(
+                f'package pkg{p}\n\n' +
+                (f'import "example.com/bench/pkg{other}"\n\n' if uses_other else '') +
+                ''.join(
+                    f'func F{n}_{j}(a, b int) int {{ return a + b + {j} }}\n'
+                    for j in range(20)) +
+                (f'\nfunc Use{n}() int {{ return pkg{other}.F0_0(1, 2) }}\n' if uses_other else ''))
+    git_commit(root)
+
+
+class UploadStandIn:
+    '''Local replacement of the upload API, counting bytes it receives'''
+
+    def __init__(self):
+        self.uploaded = 0
+        app = Flask(__name__)
+
+        @app.route('/build-request', methods=['POST'])
+        def build_request():
+            return {'url': self.location + '/upload', 'extensionHeaders': {}}
+
+        @app.route('/blobs/missing', methods=['POST'])
+        def find_missing_blobs():
+            return {'missing': request.json['digests']}
+
+        @app.route('/upload', methods=['PUT'])
+        def upload():
+            while chunk := request.stream.read(1 << 20):
+                self.uploaded += len(chunk)
+            return 'OK', 201
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self._server = make_server('localhost', 0, app, threaded=True)
+        self.location = f'http://localhost:{self._server.server_port}'
+        self._thread = Thread(target=self._server.serve_forever)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._thread.join()
+
+
+def run_upload(repo: Path, lang: str, api: UploadStandIn, cache_dir: Path, token_path: Path) -> dict:
+    '''Uploads repo, timing the phases from the moment their first line is
+    printed'''
+    env = {
+        **environ,
+        'PYTHONUNBUFFERED': '1',
+        'TERRITORY_UPLOAD_API': api.location,
+        'TERRITORY_CACHE_DIR': str(cache_dir),
+    }
+    args = [
+        executable, '-m', 'territory', '-C', str(repo), 'upload',
+        '--upload-token-path', str(token_path), '--repo-id', 'bench', '-l', lang]
+    api.uploaded = 0
+    marks = {}
+    output = []
+    stderr = []
+    start = perf_counter()
+    with Popen(args, stdout=PIPE, stderr=PIPE, text=True, env=env) as proc:
+        reader = Thread(target=lambda: stderr.append(proc.stderr.read()))
+        reader.start()
+        for line in proc.stdout:
+            output.append(line)
+            for phase, prefix in PHASES:
+                if phase not in marks and line.startswith(prefix):
+                    marks[phase] = perf_counter() - start
+        reader.join()
+        _pid, status, usage = wait4(proc.pid, 0)
+        proc.returncode = waitstatus_to_exitcode(status)
+    total = perf_counter() - start
+    if proc.returncode != 0 or len(marks) != len(PHASES):
+        raise SystemExit(f'upload of {repo} failed ({proc.returncode}):\n{"".join(output)}{stderr[0]}')
+
+    phases = {'startup': marks[PHASES[0][0]]}
+    ends = [marks[phase] for phase, _prefix in PHASES[1:]] + [total]
+    for (phase, _prefix), end in zip(PHASES, ends):
+        phases[phase] = round(end - marks[phase], 3)
+    return {
+        'seconds': phases,
+        'total': round(total, 3),
+        # ru_maxrss is in kilobytes everywhere but macOS
+        'peak_rss': usage.ru_maxrss if platform == 'darwin' else usage.ru_maxrss * 1024,
+        'uploaded': api.uploaded,
+    }
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    found = []
+    def check(name, value, old, slack, unit):
+        if value > old * (1 + tolerance) + slack:
+            found.append(f'{name}: {unit(value)} vs {unit(old)}')
+    seconds = lambda s: f'{s:.2f}s'
+    mib = lambda b: f'{b / (1 << 20):.1f} MiB'
+    for phase, value in result['seconds'].items():
+        if phase in baseline['seconds']:
+            check(phase, value, baseline['seconds'][phase], MIN_SECONDS, seconds)
+    check('total', result['total'], baseline['total'], MIN_SECONDS, seconds)
+    check('peak RSS', result['peak_rss'], baseline['peak_rss'], MIN_BYTES, mib)
+    check('uploaded', result['uploaded'], baseline['uploaded'], MIN_BYTES, mib)
+    return found
+
+
+def report(name: str, result: dict):
+    phases = ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in result['seconds'].items())
+    print(
+        f'{name:>8}: {phases}; total {result["total"]:.2f}s, '
+        f'peak RSS {result["peak_rss"] / (1 << 20):.0f} MiB, '
+        f'{result["uploaded"] / (1 << 20):.1f} MiB uploaded')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--tus', type=int, default=1000)
+    parser.add_argument('--headers', type=int, default=500)
+    parser.add_argument('--includes', type=int, default=30, help='headers included by each TU')
+    parser.add_argument('--py-modules', type=int, default=500)
+    parser.add_argument('--go-packages', type=int, default=100)
+    parser.add_argument('--go-files', type=int, default=10, help='files in each Go package')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative increase')
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    if 'go' in scenarios and 'GOSCAN_PATH' not in environ:
+        print('GOSCAN_PATH is not set, skipping the go scenario')
+        scenarios.remove('go')
+    params = {
+        'tus': args.tus, 'headers': args.headers, 'includes': args.includes,
+        'py_modules': args.py_modules, 'go_packages': args.go_packages, 'go_files': args.go_files,
+    }
+
+    results = {}
+    with TemporaryDirectory() as td, UploadStandIn() as api:
+        td = Path(td)
+        token_path = td / 'upload_token'
+        token_path.write_text('benchtoken')
+        makers = {
+            'c': lambda root: make_c_repo(root, args.tus, args.headers, args.includes),
+            'python': lambda root: make_python_repo(root, args.py_modules),
+            'go': lambda root: make_go_repo(root, args.go_packages, args.go_files),
+        }
+        for name in scenarios:
+            lang = name.removesuffix('-warm')
+            repo = td / f'repo-{lang}'
+            if not repo.exists():
+                print('generating', repo.name)
+                makers[lang](repo)
+            cache_dir = td / f'cache-{name}'
+            if name.endswith('-warm'):
+                cache_dir = td / f'cache-{lang}'
+                if not cache_dir.exists():
+                    run_upload(repo, lang, api, cache_dir, token_path)
+            print('uploading', name)
+            results[name] = run_upload(repo, lang, api, cache_dir, token_path)
+
+    baseline = None
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        if baseline['params'] != params:
+            print(f'{args.baseline} was recorded with {baseline["params"]}, not comparing')
+            baseline = None
+
+    failed = False
+    for name, result in results.items():
+        report(name, result)
+        if baseline is not None and name in baseline['scenarios']:
+            for regression in regressions(result, baseline['scenarios'][name], args.tolerance):
+                print(f'{"":>8}  REGRESSION {regression}')
+                failed = True
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps({'params': params, 'scenarios': results}, indent=2) + '\n')
+        print('saved', args.baseline)
+    elif failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
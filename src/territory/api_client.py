@@ -1,53 +1,461 @@
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5, sha256
 from pathlib import Path
+from queue import Queue
+from random import random
 from shutil import copyfileobj
 from socket import gethostname
 from sys import exit
+from time import perf_counter, sleep
 from urllib.parse import urlencode, urlparse
+import gzip
 import http.server
 import json
 import os
+import re
 import threading
 import webbrowser
 
 import requests
 from platformdirs import user_config_path
+from requests.adapters import HTTPAdapter
 
 from . import __version__
+from .cache import Cache, cache_key
+from .trace import span
 
 
 DEFAULT_UPLOAD_TOKEN_PATH = user_config_path('Territory') / 'upload_token'
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 120.0
+RETRIES = 5
+BACKOFF = 1.0
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+# statuses with which a server refuses a request without acting on it
+REFUSED_STATUS = {425, 429, 503}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
 
 
-def create_build_request(upload_token, repo_id, branch, meta, blob_size):
+class UploadAborted(Exception):
+    pass
+
+
+class RetryableError(Exception):
+    pass
+
+
+class ApiClient:
+    '''HTTP client shared by every request to the upload API and storage,
+    keeping connections alive between requests
+
+    Failed requests are retried with jittered exponential backoff when that
+    is safe: idempotent ones after any connection error, timeout or transient
+    status, others only when they never reached the server or it refused
+    them. Bodies that cannot be rewound are never retried. Hooks are called
+    after every attempt with the method, URL, status (None on errors), start
+    time and duration.
+    '''
+
+    def __init__(
+        self,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        read_timeout: float = READ_TIMEOUT,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+        pool_size: int = 8,
+        compress: bool = False,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.compress = compress
+        self.hooks = []
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = f'territory/{__version__}'
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method: str, url: str, *, idempotent: bool | None = None,
+                retries: int | None = None, backoff: float | None = None, check=None,
+                compress: bool = False, **kwargs) -> requests.Response:
+        '''Sends a request, returning the last response once it succeeds or
+        can no longer be retried
+
+        check(response) may raise RetryableError to retry a response that
+        looks successful. With compress, a json body is sent gzipped if the
+        client compresses requests.'''
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        retries = self.retries if retries is None else retries
+        backoff = self.backoff if backoff is None else backoff
+        kwargs.setdefault('timeout', self.timeout)
+        if compress and self.compress and 'json' in kwargs:
+            kwargs['data'] = gzip.compress(json.dumps(kwargs.pop('json')).encode())
+            kwargs['headers'] = {
+                **kwargs.get('headers', {}),
+                'Content-Type': 'application/json',
+                'Content-Encoding': 'gzip',
+            }
+        data = kwargs.get('data')
+        rewind = None
+        if hasattr(data, 'seek'):
+            rewind = data.tell()
+        elif data is not None and not isinstance(data, (bytes, str, dict)):
+            retries = 1
+
+        for attempt in range(retries):
+            if attempt and rewind is not None:
+                data.seek(rewind)
+            start = perf_counter()
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if check is not None and response.ok:
+                    check(response)
+            except (requests.ConnectionError, requests.Timeout, RetryableError) as e:
+                self._called(method, url, None, start)
+                retryable = idempotent or isinstance(e, (requests.ConnectTimeout, RetryableError))
+                if attempt == retries - 1 or not retryable:
+                    raise
+            else:
+                self._called(method, url, response.status_code, start)
+                status_retryable = RETRY_STATUS if idempotent else REFUSED_STATUS
+                if response.status_code not in status_retryable or attempt == retries - 1:
+                    return response
+                response.close()
+            sleep(backoff * 2 ** attempt * (0.5 + random()))
+
+    def _called(self, method, url, status, start):
+        for hook in self.hooks:
+            hook(method, url, status, start, perf_counter() - start)
+
+    def close(self):
+        self.session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client() -> ApiClient:
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = ApiClient()
+        return _default_client
+
+
+def create_build_request(upload_token, repo_id, branch, meta, blob_size, stream=False, multipart=False,
+                         client: ApiClient | None = None):
+    '''Registers a build; with stream=True blob_size is unknown and the blob
+    will be sent with chunked transfer encoding, with multipart=True the
+    server may ask for the blob to be sent in parts'''
     uploader_api_url = _uploader_api_url()
-    response = requests.post(
+    body = {
+        'repo_id': repo_id,
+        'branch': branch,
+        'meta': meta,
+        'len': blob_size,
+    }
+    if stream:
+        body['stream'] = True
+    if multipart:
+        body['multipart'] = True
+    response = (client or default_client()).request(
+        'POST',
         uploader_api_url + '/build-request',
-        json={
-            'repo_id': repo_id,
-            'branch': branch,
-            'meta': meta,
-            'len': blob_size,
-        },
-        headers={
-            'Authorization': f'Bearer {upload_token}',
-            'User-Agent': f'territory/{__version__}',
-        })
+        json=body,
+        compress=True,
+        headers={'Authorization': f'Bearer {upload_token}'})
     if not response.ok:
         print('HTTP status', response.status_code)
         exit(response.text)
     return response.json()
 
 
-def download_resource(upload_token, resource, destination):
+def find_missing_blobs(upload_token, repo_id, digests, client: ApiClient | None = None) -> set[str]:
+    '''Asks which of the given SHA-256 digests have no stored content yet'''
+    if not digests:
+        return set()
     uploader_api_url = _uploader_api_url()
-    response = requests.get(
-        uploader_api_url + '/build-resource/' + resource,
-        headers={
-            'Authorization': f'Bearer {upload_token}',
-            'User-Agent': f'territory/{__version__}',
-        })
+    # only asks, so it is safe to repeat
+    response = (client or default_client()).request(
+        'POST',
+        uploader_api_url + '/blobs/missing',
+        idempotent=True,
+        json={
+            'repo_id': repo_id,
+            'digests': list(digests),
+        },
+        headers={'Authorization': f'Bearer {upload_token}'})
+    response.raise_for_status()
+    return set(response.json()['missing'])
+
+
+def upload_file(intent, path: Path, done_parts: dict | None = None, save_progress=None,
+                concurrency: int = 4, retries: int = RETRIES, backoff: float = BACKOFF,
+                client: ApiClient | None = None):
+    '''Uploads path as requested by a build request intent
+
+    Multipart intents are uploaded concurrently, part by part.  Parts already
+    in done_parts are skipped and save_progress() is called after each part
+    is added to it, so an interrupted upload can be resumed.
+    '''
+    client = client or default_client()
+    multipart = intent.get('multipart')
+    if multipart is None:
+        with path.open('rb') as f:
+            resp = client.request(
+                'PUT', intent['url'], data=f, headers=intent['extensionHeaders'],
+                retries=retries, backoff=backoff)
+        resp.raise_for_status()
+        return
+
+    if done_parts is None:
+        done_parts = {}
+    part_size = multipart['partSize']
+    parts = multipart['parts']
+    lock = threading.Lock()
+
+    def _upload_part(number):
+        part = parts[number]
+        with path.open('rb') as f:
+            f.seek(number * part_size)
+            data = f.read(part_size)
+        digest = md5(data)
+        content_md5 = b64encode(digest.digest()).decode()
+        headers = {**part.get('headers', {}), 'Content-MD5': content_md5}
+
+        def _check(response):
+            etag = response.headers.get('ETag', '').strip('"')
+            if re.fullmatch('[0-9a-f]{32}', etag) and etag != digest.hexdigest():
+                raise RetryableError(f'checksum mismatch in part {number}')
+
+        with span('part', 'upload', number=number, bytes=len(data)):
+            response = client.request(
+                'PUT', part['url'], data=data, headers=headers, check=_check,
+                retries=retries, backoff=backoff)
+            response.raise_for_status()
+        with lock:
+            done_parts[str(number)] = {
+                'etag': response.headers.get('ETag'),
+                'md5': content_md5,
+            }
+            if save_progress is not None:
+                save_progress()
+
+    pending = [n for n in range(len(parts)) if str(n) not in done_parts]
+    if len(pending) < len(parts):
+        print('resuming upload,', len(parts) - len(pending), 'of', len(parts), 'parts already sent')
+    with ThreadPoolExecutor(concurrency, thread_name_prefix='upload') as executor:
+        for _ in executor.map(_upload_part, pending):
+            pass
+
+    # completing with the same parts again leaves the same object
+    response = client.request(
+        'POST',
+        multipart['completeUrl'],
+        idempotent=True,
+        json={
+            'parts': [
+                {'number': n, **done_parts[str(n)]}
+                for n in range(len(parts))
+            ],
+        },
+        retries=retries,
+        backoff=backoff)
     response.raise_for_status()
-    destination.write_bytes(response.content)
+
+
+class _ChunkPipe:
+    '''File-like object whose writes are sent by a consumer iterating it on another thread'''
+
+    _FAILED = object()
+
+    def __init__(self, max_chunks=32):
+        self._queue = Queue(max_chunks)
+        self._finished = False
+        self._disconnected = False
+        self.written = 0
+
+    def write(self, data) -> int:
+        if self._disconnected:
+            raise UploadAborted('the upload connection was closed')
+        if data:
+            self._queue.put(bytes(data))
+            self.written += len(data)
+        return len(data)
+
+    def close(self, failed=False):
+        self._queue.put(self._FAILED if failed else None)
+
+    def __iter__(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._finished = True
+                return
+            if chunk is self._FAILED:
+                self._finished = True
+                # abandon the request so that the server never sees a complete body
+                raise UploadAborted('archive creation failed')
+            yield chunk
+
+    def disconnect(self):
+        '''Stops consuming, unblocking and failing further writes'''
+        self._disconnected = True
+        while not self._finished:
+            chunk = self._queue.get()
+            if chunk is None or chunk is self._FAILED:
+                self._finished = True
+
+
+def stream_upload(intent, write, client: ApiClient | None = None) -> int:
+    '''Uploads everything write(fileobj) writes, while it is being written,
+    returning the number of bytes sent'''
+    client = client or default_client()
+    pipe = _ChunkPipe()
+    outcome = {}
+
+    def _put():
+        try:
+            # the body is gone once sent, so this is never retried
+            outcome['response'] = client.request(
+                'PUT', intent['url'], data=iter(pipe), headers=intent['extensionHeaders'], retries=1)
+        except BaseException as e:
+            outcome['error'] = e
+        finally:
+            pipe.disconnect()
+
+    thread = threading.Thread(target=_put, name='upload')
+    thread.start()
+    try:
+        write(pipe)
+    except BaseException as e:
+        pipe.close(failed=True)
+        thread.join()
+        # when the upload stopped first, its outcome explains the failure
+        if isinstance(e, UploadAborted):
+            if 'error' in outcome:
+                raise outcome['error']
+            outcome['response'].raise_for_status()
+        raise
+    pipe.close()
+    thread.join()
+
+    if 'error' in outcome:
+        raise outcome['error']
+    outcome['response'].raise_for_status()
+    return pipe.written
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def download_resource(upload_token, resource, destination: Path, etag: str | None = None,
+                      client: ApiClient | None = None) -> dict | None:
+    '''Streams a build resource to destination, replacing it only once the
+    download is complete and its checksum verified
+
+    With etag, nothing is downloaded and None is returned if the server still
+    has that version. Otherwise returns the ETag and SHA-256 of the download.'''
+    uploader_api_url = _uploader_api_url()
+    headers = {'Authorization': f'Bearer {upload_token}'}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    response = (client or default_client()).request(
+        'GET', uploader_api_url + '/build-resource/' + resource, headers=headers, stream=True)
+    with response:
+        if etag is not None and response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = destination.with_name(f'{destination.name}.{os.getpid()}.tmp')
+        md5_digest = md5()
+        sha256_digest = sha256()
+        size = 0
+        try:
+            with tmp_path.open('wb') as f:
+                for chunk in response.iter_content(1 << 20):
+                    f.write(chunk)
+                    md5_digest.update(chunk)
+                    sha256_digest.update(chunk)
+                    size += len(chunk)
+            _verify_download(response.headers, size, md5_digest, sha256_digest)
+            tmp_path.replace(destination)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    return {'etag': response.headers.get('ETag'), 'sha256': sha256_digest.hexdigest()}
+
+
+def _verify_download(headers, size: int, md5_digest, sha256_digest):
+    '''Checks a download against whatever length and digests the server sent'''
+    expected_size = headers.get('Content-Length')
+    # a compressed transfer has the length of the compressed body
+    if expected_size is not None and 'Content-Encoding' not in headers and int(expected_size) != size:
+        raise ChecksumMismatch(f'received {size} of {expected_size} bytes')
+    expected = {}
+    for header in ('x-goog-hash', 'Repr-Digest', 'Digest'):
+        for item in headers.get(header, '').split(','):
+            algorithm, _, value = item.strip().partition('=')
+            algorithm = {'md5': 'md5', 'sha-256': 'sha256'}.get(algorithm.lower())
+            if algorithm and value:
+                expected[algorithm] = b64decode(value.strip(':')).hex()
+    actual = {'md5': md5_digest.hexdigest(), 'sha256': sha256_digest.hexdigest()}
+    for algorithm, digest in expected.items():
+        if actual[algorithm] != digest:
+            raise ChecksumMismatch(f'{algorithm} of the download is {actual[algorithm]}, expected {digest}')
+
+
+def cached_resource(upload_token, resource, cache_dir: Path | None, temp_dir: Path,
+                    client: ApiClient | None = None) -> Path:
+    '''Path of a build resource, downloaded again only when the server has a
+    newer version than the copy cached for this client version
+
+    The cached copy is used as it is when the server cannot be reached.
+    Without a cache_dir the resource is downloaded into temp_dir.'''
+    if cache_dir is None:
+        path = temp_dir / resource
+        download_resource(upload_token, resource, path, client=client)
+        return path
+
+    resources = Cache(cache_dir / 'resources')
+    key = cache_key('resource', resource, __version__, _uploader_api_url())
+    path = cache_dir / 'resources' / 'blobs' / key
+    entry = resources.get(key)
+    if entry is not None and not _intact(path, entry['sha256']):
+        print('cached', resource, 'is damaged, downloading it again')
+        entry = None
+
+    try:
+        fetched = download_resource(
+            upload_token, resource, path, etag=entry['etag'] if entry is not None else None,
+            client=client)
+    except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+        if entry is None:
+            raise
+        print(f'could not check for a newer {resource} ({e}), using the cached one')
+        return path
+    if fetched is None:
+        print('using cached', resource)
+    else:
+        resources.put(key, fetched)
+    return path
+
+
+def _intact(path: Path, expected_sha256: str) -> bool:
+    h = sha256()
+    try:
+        with path.open('rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+    except FileNotFoundError:
+        return False
+    return h.hexdigest() == expected_sha256
 
 
 def _uploader_api_url():
@@ -1,39 +1,99 @@
+from array import array
 from dataclasses import dataclass
 from hashlib import blake2b
 from multiprocessing import cpu_count
 from multiprocessing.pool import Pool
-from os import environ
+from os import environ, getpid
+from os.path import isdir, join, normpath
 from pathlib import Path
+from shutil import which
 from subprocess import DEVNULL, PIPE, run
+from time import perf_counter
 import json
 import re
 import shlex
 
 import tqdm
 
-from .files import find_in_ancestors
+from .cache import Cache, cache_key
+from .files import file_digest, find_in_ancestors, normalize_tarinfo
+from .memory import Admission, run_measured
+from .paths import PathSet, PathTable, pack_paths, unpack_paths
+from .schedule import JobHistory, plan_batches
+from .trace import active, span
+
+
+SCANNERS = ['auto', 'clang-scan-deps', 'make-deps', 'preprocess']
 
 
 class Lang:
-    def prepare_package(self, package):
+    def __init__(self, scanner='auto'):
+        self.scanner = scanner
+
+    def setup(self, package):
         self.compile_commands_dir = find_compile_commands_dir(package.work_dir)
         print('compilation database:', self.compile_commands_dir / 'compile_commands.json')
-
         self.cc_path = self.compile_commands_dir / 'compile_commands.json'
-        cc_data = read_compile_commands(self.cc_path)
-        cc_files = collect_details(package.temp_dir, self.compile_commands_dir, cc_data)
-        package.captured_files.update(cc_files)
+
+    def prepare_package(self, package):
+        # dependencies of every TU, remembered for the next incremental upload
+        # as indices into a list of paths
+        self.tus = {}
+        state_ids: dict[str, int] = {}
+        previous = {}
+        if package.delta is not None:
+            previous_paths = package.delta.previous.get('paths', [])
+            previous = package.delta.previous.get('tus', {}) if previous_paths else {}
+            changed = {j for j, p in enumerate(previous_paths) if package.delta.intersects([p])}
+
+        # commands are scanned while the database is still being read
+        cc_data = []
+        keys = []
+        def read():
+            for cmd in iter_compile_commands(self.cc_path):
+                key = _tu_key(cmd, self.compile_commands_dir)
+                if package.delta is not None:
+                    deps = previous.get(key)
+                    if deps is not None and changed.isdisjoint(deps):
+                        self.tus[key] = [
+                            state_ids.setdefault(previous_paths[j], len(state_ids)) for j in deps]
+                        continue
+                keys.append(key)
+                cc_data.append(cmd)
+                yield cmd
+
+        cache = None
+        if package.cache_dir is not None:
+            cache = Cache(package.cache_dir / 'c-details')
+        table = package.captured_files.table
+        tu_deps = {}
+        collect_details(
+            package.temp_dir, self.compile_commands_dir, read(), cache, self.scanner,
+            on_paths=package.capture, tu_deps=tu_deps, table=table)
+        if package.delta is not None:
+            print(len(cc_data), 'of', len(cc_data) + len(self.tus), 'translation units affected by changes')
+        for i, ids in tu_deps.items():
+            self.tus[keys[i]] = sorted({
+                state_ids.setdefault(normpath(table.name(j)), len(state_ids)) for j in ids})
+        self.paths = list(state_ids)
         self.gen_ccs_path = Path(package.temp_dir, 'compile_commands.json')
-        with self.gen_ccs_path.open('w') as f:
-            json.dump(cc_data, f, indent=4)
+        write_compile_commands(self.gen_ccs_path, cc_data)
 
     def add_to_tar_file(self, package, output):
-        output.add(self.gen_ccs_path, arcname=self.cc_path)
+        output.add(self.gen_ccs_path, arcname=self.cc_path, filter=normalize_tarinfo)
 
     def add_to_meta(self, meta):
         meta['compile_commands_dir'] = str(self.compile_commands_dir)
         meta['lang'] = 'c'
 
+    def incremental_state(self):
+        return {'paths': self.paths, 'tus': self.tus}
+
+
+def _tu_key(cmd, cc_dir):
+    dir_ = cmd.get('directory') or str(cc_dir)
+    return cache_key(dir_, cmd['file'], cmd.get('arguments'))
+
 
 def find_compile_commands_dir(p):
     try:
@@ -43,49 +103,216 @@ def find_compile_commands_dir(p):
 
 
 def read_compile_commands(cc_path):
-    with cc_path.open('r') as f:
-        cc_data = json.load(f)
+    return list(iter_compile_commands(cc_path))
+
 
-    for cc in cc_data:
+def iter_compile_commands(cc_path, chunk_size=1 << 20):
+    '''Yields the commands of a compilation database as they are read, with
+    command strings split into arguments'''
+    with cc_path.open('r') as f:
+        for cc in _iter_json_array(f, chunk_size):
+            try:
+                cmd_str = cc.pop('command')
+            except KeyError:
+                pass
+            else:
+                cc['arguments'] = shlex.split(cmd_str)
+            yield cc
+
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def _iter_json_array(f, chunk_size):
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size).lstrip()
+    if not buf.startswith('['):
+        raise ValueError('compilation database is not a JSON array')
+    pos = 1
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == ']':
+            return
         try:
-            cmd_str = cc.pop('command')
-        except KeyError:
+            if pos == len(buf):
+                raise json.JSONDecodeError('unexpected end of data', buf, pos)
+            value, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # the element is incomplete, read as much again as is buffered
+            more = f.read(max(chunk_size, len(buf) - pos))
+            if not more:
+                raise
+            buf = buf[pos:] + more
+            pos = 0
             continue
-        cc['arguments'] = shlex.split(cmd_str)
-
-    return cc_data
+        yield value
 
 
-def collect_details(tmp_dir, cc_dir, cc_data):
+def write_compile_commands(cc_path, cc_data):
+    '''Writes a compilation database one command at a time'''
+    with cc_path.open('w') as f:
+        f.write('[')
+        for i, cmd in enumerate(cc_data):
+            f.write(',\n' if i else '\n')
+            f.write(json.dumps(cmd, separators=(',', ':')))
+        f.write('\n]\n')
+
+
+def collect_details(
+    tmp_dir,
+    cc_dir,
+    cc_data,
+    cache: Cache | None = None,
+    scanner='auto',
+    on_paths=None,
+    tu_deps: dict | None = None,
+    table: PathTable | None = None,
+):
+    '''Finds dependencies of every TU and rewrites its arguments for indexing,
+    returning the set of all dependencies
+
+    cc_data can be any iterable; cached details are looked up while it is being
+    read. Paths are interned in table; tu_deps, if given, receives the ids of
+    the dependencies of each TU by its position in cc_data.'''
+    history = JobHistory(cache, str(cc_dir))
     if 'CORES' in environ:
         procs = int(environ['CORES'])
     else:
-        procs = cpu_count() * 2
+        procs = history.default_procs([cpu_count() * 2, cpu_count()])
 
+    trace = active()
+    admission = Admission()
+    dep_paths = PathSet(table)
+    touched: dict[int, int] = {}
     with \
-            Pool(procs) as pool, \
-            tqdm.tqdm(total=len(cc_data), desc='collecting compilation details') as progr:
-        dep_paths = set()
+            Pool(procs, _init_worker, (admission,)) as pool, \
+            tqdm.tqdm(desc='collecting compilation details') as progr:
         def _cb(details):
-            idx, paths, arguments = details
-            dep_paths.update(paths)
-            cc_data[idx]['arguments'] = arguments
+            idx, blob, arguments = details
+            paths = unpack_paths(blob)
+            ids = dep_paths.table.intern_all(paths)
+            dep_paths.add_ids(ids)
+            commands[idx]['arguments'] = arguments
+            touched[idx] = len(paths)
+            if tu_deps is not None:
+                tu_deps[idx] = array('I', [source_ids[idx], *ids])
             progr.update(1)
+            if on_paths is not None:
+                on_paths(paths)
         def _ecb(e):
             print('error:', e)
             progr.update(1)
-        for i, cmd in enumerate(cc_data):
-            dir_ = cmd.get('directory') or cc_dir
-            p = Path(dir_, cmd['file'])
-            dep_paths.add(p)
+        def _batch_cb(results):
+            for idx, details, start, seconds, peak_rss, returncode, pid in results:
+                history.record(sources[idx], seconds, peak_rss)
+                if trace is not None:
+                    error = {'error': str(details)} if isinstance(details, Exception) else {}
+                    trace.record(
+                        sources[idx], 'compile', start, seconds, pid=pid, tid=pid,
+                        exit_code=returncode, peak_rss=peak_rss, **error)
+                if isinstance(details, Exception):
+                    _ecb(details)
+                else:
+                    _cb(details)
+
+        commands = []
+        dirs = []
+        sources = []
+        def read():
+            for cmd in cc_data:
+                dir_ = cmd.get('directory') or cc_dir
+                commands.append(cmd)
+                dirs.append(dir_)
+                sources.append(str(Path(dir_, cmd['file'])))
+                source_ids.append(dep_paths.table.intern(sources[-1]))
+                yield len(commands) - 1
+            progr.total = len(commands)
+            progr.refresh()
+
+        source_ids = []
+        with span('read compilation database'):
+            if cache is not None:
+                misses = []
+                lookups = ((i, dirs[i], commands[i], cache) for i in read())
+                for i, hit in pool.imap_unordered(_lookup_details, lookups, chunksize=16):
+                    if hit is None:
+                        misses.append(i)
+                    else:
+                        _cb((i, *hit))
+                misses.sort()
+            else:
+                misses = list(read())
+        dep_paths.add_ids(source_ids)
+        if on_paths is not None:
+            on_paths(sources)
+
+        probes = [_toolchain_probe(dirs[i], commands[i]) for i in misses]
+        toolchains = dict.fromkeys(probes)
+        if toolchains:
+            print('probing', len(toolchains), 'toolchain configurations')
+        with span('probe toolchains'):
+            toolchains = dict(zip(toolchains, pool.starmap(_probe_toolchain, toolchains)))
+
+        vees = [toolchains[probe] for probe in probes]
+        scanners = {}
+        batches = {}
+        for i, vee in zip(misses, vees):
+            compiler = (commands[i]['arguments'][0], dirs[i])
+            if compiler not in scanners:
+                scanners[compiler] = _choose_scanner(scanner, *compiler)
+            batches.setdefault(scanners[compiler], []).append((i, vee))
+
+        rescan = batches.setdefault('make-deps', [])
+        for scanner_path, batch in list(batches.items()):
+            if scanner_path in ('make-deps', 'preprocess'):
+                continue
+            indices = [i for i, _vee in batch]
+            with span('clang-scan-deps', files=len(indices)):
+                found = _scan_deps(scanner_path, tmp_dir, dirs, commands, indices, procs)
+            for i, vee in batch:
+                if i in found:
+                    pool.apply_async(
+                        _details_result,
+                        (i, dirs[i], commands[i], vee, found[i], cache),
+                        {},
+                        callback=_cb,
+                        error_callback=_ecb)
+                else:
+                    rescan.append((i, vee))
+
+        # longest first, so that a slow TU does not start last and hold up the run
+        jobs = [(i, vee, mode) for mode in ('make-deps', 'preprocess') for i, vee in batches.get(mode, ())]
+        planned = plan_batches(jobs, lambda job: history.expected(sources[job[0]]))
+        start = perf_counter()
+        for batch in planned:
             pool.apply_async(
-                _query_details,
-                (i, cc_dir, tmp_dir, cmd),
+                _query_batch,
+                ([
+                    (i, cc_dir, tmp_dir, commands[i], vee, cache, mode, history.expected_rss(sources[i]))
+                    for i, vee, mode in batch
+                ],),
                 {},
-                callback=_cb,
+                callback=_batch_cb,
                 error_callback=_ecb)
         pool.close()
         pool.join()
+        seconds = perf_counter() - start
+        if trace is not None:
+            trace.record('run compilers', 'phase', start, seconds, jobs=len(jobs), procs=procs)
+
+    history.record_throughput(procs, len(jobs), seconds)
+    history.report(procs, seconds)
+    if touched:
+        most = max(touched, key=touched.get)
+        print(
+            f'{sum(touched.values()) / len(touched):.0f} files per translation unit on average, '
+            f'most in {sources[most]} ({touched[most]})')
+    if admission.waited >= 1:
+        print(f'waited {admission.waited:.1f}s for memory to start compilers')
+    history.save()
+
+    if cache is not None:
+        cache.evict()
 
     return dep_paths
 
@@ -127,70 +354,519 @@ def parse_vee(text) -> Vee:
     return vee
 
 
-def _query_details(index: int, cc_dir: Path, tmp_dir: Path, compilation_command):
-    q_arguments = compilation_command['arguments'][:]
+# Flags which select the target and the system include search list.  Those
+# in _TOOLCHAIN_SEPARATE take the following argument as their value.
+_TOOLCHAIN_SEPARATE = {
+    '-target', '-isystem', '-idirafter', '-cxx-isystem', '--stdlib++-isystem',
+    '-iframework', '-iframeworkwithsysroot', '-isysroot', '--sysroot', '-x',
+    '-B', '--gcc-toolchain', '-resource-dir', '-imultilib',
+}
+_TOOLCHAIN_PREFIXES = (
+    '--target=', '-isystem', '-idirafter', '-cxx-isystem', '-iframework',
+    '-isysroot', '--sysroot=', '-x', '-B', '--gcc-toolchain=', '-resource-dir=',
+    '-stdlib=', '-std=', '--std=', '-imultilib',
+)
+_TOOLCHAIN_SWITCHES = {
+    '-nostdinc', '-nostdinc++', '-nostdlibinc', '-nobuiltininc',
+    '-m16', '-m32', '-m64', '-mx32',
+}
+
+_LANGUAGES = {
+    '.c': 'c', '.i': 'c',
+    '.cc': 'c++', '.cp': 'c++', '.cxx': 'c++', '.cpp': 'c++', '.CPP': 'c++',
+    '.c++': 'c++', '.C': 'c++', '.ii': 'c++', '.hh': 'c++', '.hpp': 'c++',
+    '.hxx': 'c++', '.m': 'objective-c', '.mm': 'objective-c++',
+}
+
+
+def _toolchain_args(arguments) -> list[str]:
+    res = []
+    i = 1
+    while i < len(arguments):
+        arg = arguments[i]
+        if arg in _TOOLCHAIN_SEPARATE:
+            res.extend(arguments[i:i+2])
+            i += 2
+            continue
+        if arg in _TOOLCHAIN_SWITCHES or arg.startswith(_TOOLCHAIN_PREFIXES):
+            res.append(arg)
+        i += 1
+    return res
 
-    q_arguments = remove_arg(q_arguments, '-c', 1)
-    q_arguments = remove_arg(q_arguments, '-M', 1)
-    q_arguments = remove_arg(q_arguments, '-MD', 1)
-    q_arguments = remove_arg(q_arguments, '-MM', 1)
-    q_arguments = remove_arg(q_arguments, '-MMD', 1)
-    q_arguments = remove_arg(q_arguments, '-o', 2, prefix=True)
-    q_arguments = remove_arg(q_arguments, '-MF', 2, prefix=True)
 
-    deps_dir = tmp_dir / 'deps'
-    deps_dir.mkdir(parents=True, exist_ok=True)
-    deps_file = deps_dir / (blake2b(compilation_command['file'].encode()).hexdigest() + '.d')
+def _toolchain_probe(dir_, compilation_command) -> tuple:
+    '''Returns the arguments of a preprocessor run on empty input that reports
+    the same target and system include paths as the compilation command'''
+    arguments = compilation_command['arguments']
+    compiler = arguments[0]
+    toolchain_args = _toolchain_args(arguments)
+    if any(a.startswith('-x') for a in toolchain_args):
+        language = []
+    else:
+        lang = _LANGUAGES.get(Path(compilation_command['file']).suffix)
+        if lang is None:
+            lang = 'c++' if '++' in Path(compiler).name else 'c'
+        language = ['-x', lang]
+    return str(dir_), (compiler, *toolchain_args, *language, '-E', '-v', '-o', '/dev/null', '/dev/null')
+
 
-    q_arguments = [q_arguments[0], '-E', '-MD', '-MF' + str(deps_file), *q_arguments[1:], '-v', '-o', '/dev/null', '-Wno-error']
+def _probe_toolchain(dir_, probe_arguments) -> Vee:
     completion = run(
-        q_arguments,
-        cwd=compilation_command.get('directory') or cc_dir,
+        probe_arguments,
+        cwd=dir_,
         stderr=PIPE,
         stdin=DEVNULL,
         text=True)
+    if completion.returncode != 0:
+        print('toolchain probe failed:', shlex.join(probe_arguments))
+        print(completion.stderr)
+    return parse_vee(completion.stderr)
 
-    arguments = compilation_command['arguments'][:]
-    vd = parse_vee(completion.stderr)
-    if vd.target is not None:
-        arguments[1:1] = ['-target', vd.target]
-
-    if vd.angle_bracket_include_paths:
-        arguments = remove_arg(arguments, '-I', 2, prefix=True)
-        arguments = remove_arg(arguments, '--include-directory', 2)
-        arguments = remove_arg(arguments, '--include-directory=', 1, prefix=True)
-        arguments = remove_arg(arguments, '-cxx-isystem', 2, prefix=True)
-        arguments = remove_arg(arguments, '-ibuiltininc', 1)
-        arguments = remove_arg(arguments, '-iframework', 2, prefix=True)
-        arguments = remove_arg(arguments, '-iframeworkwithsysroot', 2, prefix=True)
-        arguments = remove_arg(arguments, '--stdlib++-isystem', 2, prefix=True)
-        arguments = remove_arg(arguments, '-isystem', 2, prefix=True)
-        arguments = remove_arg(arguments, '-M', 1)
-        arguments = remove_arg(arguments, '-MD', 1)
-        arguments = remove_arg(arguments, '-MM', 1)
-        arguments = remove_arg(arguments, '-MMD', 1)
-        arguments = remove_arg(arguments, '-MF', 2, prefix=True)
-
-        incs = [f'-I{dir}' for dir in vd.angle_bracket_include_paths]
-        arguments[1:1] = ['-nostdinc', *incs]
-
-    if deps_file.exists():
-        deps_text = deps_file.read_text()
-        deps_file.unlink()
+
+# normalized include directories, None for missing ones, as checked by this
+# worker process, keyed by working directory and directory as given
+_dirs: dict[tuple[str, str], str | None] = {}
+
+
+def _include_dir(dir_, d) -> str | None:
+    key = (dir_, d)
+    try:
+        return _dirs[key]
+    except KeyError:
+        norm = normpath(join(dir_, d))
+        _dirs[key] = norm if isdir(norm) else None
+        return _dirs[key]
+
+
+def _merge_include_paths(user_dirs, system_dirs, dir_) -> list[str]:
+    '''Lists include directories in the order the compiler searches them, skipping
+    missing directories and duplicates the way the compiler does'''
+    dir_ = str(dir_)
+    seen = {normpath(join(dir_, d)) for d in system_dirs}
+    res = []
+    for d in user_dirs:
+        norm = _include_dir(dir_, d)
+        if norm is not None and norm not in seen:
+            seen.add(norm)
+            res.append(d)
+    return res + system_dirs
+
+
+@dataclass(frozen=True)
+class ArgumentRule:
+    flag: str
+    # arguments removed, counting the flag, when the flag is given on its own
+    arity: int
+    # whether the flag with its value joined to it is removed too
+    prefix: bool
+    # whether the argument is removed for dependency scans
+    scan: bool
+    # whether the argument is removed when the include search list is made explicit
+    index: bool
+    # whether the value is a user include directory
+    include_dir: bool = False
+
+
+# Rules are tried in order; the first one matching an argument applies.
+ARGUMENT_RULES = [
+    ArgumentRule('-c', 1, False, scan=True, index=False),
+    ArgumentRule('-o', 2, True, scan=True, index=False),
+    ArgumentRule('-I', 2, True, scan=False, index=True, include_dir=True),
+    ArgumentRule('--include-directory', 2, False, scan=False, index=True, include_dir=True),
+    ArgumentRule('--include-directory=', 1, True, scan=False, index=True, include_dir=True),
+    ArgumentRule('-cxx-isystem', 2, True, scan=False, index=True),
+    ArgumentRule('-ibuiltininc', 1, False, scan=False, index=True),
+    ArgumentRule('-iframework', 2, True, scan=False, index=True),
+    ArgumentRule('-iframeworkwithsysroot', 2, True, scan=False, index=True),
+    ArgumentRule('--stdlib++-isystem', 2, True, scan=False, index=True),
+    ArgumentRule('-isystem', 2, True, scan=False, index=True),
+    ArgumentRule('-M', 1, False, scan=True, index=True),
+    ArgumentRule('-MD', 1, False, scan=True, index=True),
+    ArgumentRule('-MM', 1, False, scan=True, index=True),
+    ArgumentRule('-MMD', 1, False, scan=True, index=True),
+    ArgumentRule('-MF', 2, True, scan=True, index=True),
+]
+
+
+class ArgumentRewriter:
+    '''Removes arguments matching a table of rules in a single pass over a
+    command, producing the arguments for dependency scans and for indexing at
+    once
+
+    An argument equal to a rule's flag is removed with the arity - 1 arguments
+    following it; with prefix, an argument starting with the flag is removed
+    on its own. Each output skips the values of the flags removed from it.
+    '''
+
+    def __init__(self, rules: list[ArgumentRule]):
+        # rules by the first two characters of their flag, which all matching
+        # arguments share
+        self._rules: dict[str, list[ArgumentRule]] = {}
+        for rule in rules:
+            self._rules.setdefault(rule.flag[:2], []).append(rule)
+        self._flags = {r.flag for r in rules}
+        self._prefixes = tuple(r.flag for r in rules if r.prefix)
+        self._matches: dict[str, tuple] = {}
+
+    def _match(self, arg: str) -> tuple:
+        '''Returns (rule, arguments removed) of the first rule for scans and for
+        indexing matching arg'''
+        matches = self._matches.get(arg)
+        if matches is None:
+            scan = index = None
+            for rule in self._rules.get(arg[:2], ()):
+                if arg == rule.flag:
+                    match = rule, rule.arity
+                elif rule.prefix and arg.startswith(rule.flag):
+                    match = rule, 1
+                else:
+                    continue
+                if scan is None and rule.scan:
+                    scan = match
+                if index is None and rule.index:
+                    index = match
+            matches = scan, index
+            # only flags are remembered, joined values are mostly unique
+            if arg in self._flags:
+                self._matches[arg] = matches
+        return matches
+
+    def rewrite(self, arguments: list[str], explicit_includes: bool) -> tuple[list[str], list[str], list[str]]:
+        '''Returns the arguments for dependency scans, the arguments for
+        indexing, and the user include directories
+
+        Unless explicit_includes, no arguments are removed for indexing.'''
+        scan = []
+        index = []
+        include_dirs = []
+        skip_scan = skip_index = 0
+        take_include = False
+        flags = self._flags
+        prefixes = self._prefixes
+        for arg in arguments:
+            if arg not in flags and not arg.startswith(prefixes):
+                if skip_scan:
+                    skip_scan -= 1
+                else:
+                    scan.append(arg)
+                if skip_index:
+                    skip_index -= 1
+                    if take_include:
+                        include_dirs.append(arg)
+                        take_include = False
+                else:
+                    index.append(arg)
+                continue
+
+            scan_match, index_match = self._match(arg)
+            if skip_scan:
+                skip_scan -= 1
+            elif scan_match is None:
+                scan.append(arg)
+            else:
+                skip_scan = scan_match[1] - 1
+
+            if skip_index:
+                skip_index -= 1
+                if take_include:
+                    include_dirs.append(arg)
+                    take_include = False
+            elif index_match is None or not explicit_includes:
+                index.append(arg)
+            else:
+                rule, removed = index_match
+                skip_index = removed - 1
+                if rule.include_dir:
+                    if removed > 1:
+                        take_include = True
+                    else:
+                        include_dirs.append(arg[len(rule.flag):])
+        return scan, index, include_dirs
+
+
+_REWRITER = ArgumentRewriter(ARGUMENT_RULES)
+
+
+def split_arguments(arguments, vee: Vee, dir_) -> tuple[list[str], list[str]]:
+    '''Rewrites a compilation command in one pass, returning the arguments to
+    find its dependencies with and the arguments to index it with'''
+    explicit_includes = bool(vee.angle_bracket_include_paths)
+    scan, index, user_dirs = _REWRITER.rewrite(arguments, explicit_includes)
+    if vee.target is not None:
+        index[1:1] = ['-target', vee.target]
+    if explicit_includes:
+        include_paths = _merge_include_paths(user_dirs, vee.angle_bracket_include_paths, dir_)
+        index[1:1] = ['-nostdinc', *(f'-I{dir}' for dir in include_paths)]
+    return scan, index
+
+
+def rewrite_arguments(arguments, vee: Vee, dir_) -> list[str]:
+    '''Makes the target and include search list of a compilation command explicit'''
+    return split_arguments(arguments, vee, dir_)[1]
+
+
+# digests of files seen by this worker process, keyed by path and stat
+_digests: dict[tuple[Path, int, int], str] = {}
+
+
+def _cached_digest(path: Path) -> str | None:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    key = (path, st.st_size, st.st_mtime_ns)
+    digest = _digests.get(key)
+    if digest is None:
+        digest = _digests[key] = file_digest(path)
+    return digest
+
+
+def _compiler_stamp(compiler: str, dir_) -> list | None:
+    if '/' in compiler:
+        path = Path(dir_, compiler)
+    else:
+        found = which(compiler)
+        if not found:
+            return None
+        path = Path(found)
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return [str(path), st.st_size, st.st_mtime_ns]
+
+
+def _details_key(dir_, compilation_command) -> str:
+    arguments = compilation_command['arguments']
+    return cache_key(
+        'c-details',
+        _compiler_stamp(arguments[0], dir_),
+        str(dir_),
+        compilation_command['file'],
+        arguments)
+
+
+def _cached_details(cache: Cache, key: str, dir_):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    for f, digest in entry['deps'].items():
+        if _cached_digest(Path(dir_, f)) != digest:
+            return None
+    return pack_paths(Path(dir_, f) for f in entry['deps']), entry['arguments']
+
+
+def _lookup_details(job):
+    index, dir_, compilation_command, cache = job
+    return index, _cached_details(cache, _details_key(dir_, compilation_command), dir_)
+
+
+def _store_details(cache: Cache, key: str, dir_, files, arguments):
+    deps = {}
+    for f in files:
+        digest = _cached_digest(Path(dir_, f))
+        if digest is None:
+            return
+        deps[f] = digest
+    cache.put(key, {'deps': deps, 'arguments': arguments})
+
+
+_CONTINUATION = re.compile(r'\\\r?\n')
+_RULE_COLON = re.compile(r'(?<!\\):(?=\s|$)')
+_WORD = re.compile(r'(?:\\[ \t]|\S)+')
+_ESCAPE = re.compile(r'\\\\(?=\\[ \t#])|\\([ \t#])|\$(\$)')
+
+
+def _unescape_make(word: str) -> str:
+    return _ESCAPE.sub(lambda m: m.group(1) or m.group(2) or '\\', word)
+
+
+def parse_make_rules(text) -> dict[str, list[str]]:
+    '''Reads targets and prerequisites from a dependency file written by the compiler
+
+    Handles continuation lines, spaces and hashes escaped with a backslash,
+    dollars doubled for make and colons in Windows drive letters.'''
+    rules = {}
+    for line in _CONTINUATION.sub(' ', text).splitlines():
+        if not line.strip():
+            continue
+        colon = _RULE_COLON.search(line)
+        if colon is None:
+            raise ValueError(f'not a make rule: {line!r}')
+        target = _unescape_make(line[:colon.start()].strip())
+        rules.setdefault(target, []).extend(
+            _unescape_make(word) for word in _WORD.findall(line, colon.end()))
+    return rules
+
+
+def find_clang_scan_deps(compiler, dir_) -> str | None:
+    if 'CLANG_SCAN_DEPS' in environ:
+        return environ['CLANG_SCAN_DEPS']
+
+    m = re.fullmatch(r'clang(?:\+\+)?(-[0-9.]+)?', Path(compiler).name)
+    if not m:
+        return None
+    name = 'clang-scan-deps' + (m.group(1) or '')
+
+    if '/' in compiler:
+        compiler_path = Path(dir_, compiler)
+    else:
+        compiler_path = which(compiler)
+    if compiler_path:
+        sibling = Path(compiler_path).resolve().parent / name
+        if sibling.exists():
+            return str(sibling)
+
+    return which(name) or which('clang-scan-deps')
+
+
+def _choose_scanner(scanner, compiler, dir_) -> str:
+    if scanner in ('make-deps', 'preprocess'):
+        return scanner
+    scan_deps = find_clang_scan_deps(compiler, dir_)
+    if scan_deps is not None:
+        return scan_deps
+    if scanner == 'clang-scan-deps':
+        raise SystemExit(f'clang-scan-deps not found for {compiler}')
+    return 'make-deps'
+
+
+def _dependency_arguments(arguments) -> list[str]:
+    return _REWRITER.rewrite(arguments, explicit_includes=False)[0]
+
+
+def _scan_deps(scan_deps: str, tmp_dir: Path, dirs, cc_data, indices, procs) -> dict[int, list[str]]:
+    '''Finds dependencies of many TUs with a single clang-scan-deps run'''
+    scan_dir = tmp_dir / 'scan-deps'
+    scan_dir.mkdir(parents=True, exist_ok=True)
+    db_path = scan_dir / (blake2b(scan_deps.encode()).hexdigest() + '.json')
+    with db_path.open('w') as f:
+        json.dump([
+            {
+                'directory': str(dirs[i]),
+                'file': cc_data[i]['file'],
+                'arguments': [
+                    *_dependency_arguments(cc_data[i]['arguments']),
+                    '-MT', f'tu-{i}', '-Wno-error'],
+            }
+            for i in indices
+        ], f)
+
+    print('scanning dependencies of', len(indices), 'files with', scan_deps)
+    completion = run(
+        [scan_deps, '-compilation-database', str(db_path), '-format', 'make', '-j', str(procs)],
+        stdout=PIPE,
+        stderr=PIPE,
+        stdin=DEVNULL,
+        text=True)
+    if completion.returncode != 0:
+        print(completion.stderr)
+
+    try:
+        rules = parse_make_rules(completion.stdout)
+    except ValueError as e:
+        print('failed to read dependencies:', e)
+        return {}
+    return {
+        int(target.removeprefix('tu-')): deps
+        for target, deps in rules.items()
+        if target.startswith('tu-')
+    }
+
+
+def _details_result(
+    index: int,
+    dir_,
+    compilation_command,
+    vee: Vee,
+    files,
+    cache: Cache | None,
+    arguments: list[str] | None = None,
+):
+    if arguments is None:
+        arguments = rewrite_arguments(compilation_command['arguments'], vee, dir_)
+    if files is None:
+        return index, b'', arguments
+
+    if cache is not None:
+        _store_details(cache, _details_key(dir_, compilation_command), dir_, files, arguments)
+
+    return index, pack_paths(Path(dir_, f) for f in files), arguments
+
+
+_admission: Admission | None = None
+
+
+def _init_worker(admission: Admission):
+    global _admission
+    _admission = admission
+
+
+def _query_batch(jobs):
+    '''Runs _query_details for every job, timing each and returning errors
+    instead of raising them, so one failure does not lose the whole batch'''
+    results = []
+    for job in jobs:
+        start = perf_counter()
+        peak_rss = returncode = None
         try:
-            _target, deps = deps_text.split(':', 1)
+            details, peak_rss, returncode = _query_details(*job)
         except Exception as e:
-            print('failed to read dependencies:', deps_text, e)
-            return index, set(), arguments
-        lines = [l.rstrip('\\') for l in deps.splitlines()]
-        files = shlex.split(' '.join(lines))
+            details = e
+        results.append((job[0], details, start, perf_counter() - start, peak_rss, returncode, getpid()))
+    return results
+
+
+def _query_details(
+    index: int,
+    cc_dir: Path,
+    tmp_dir: Path,
+    compilation_command,
+    vee: Vee,
+    cache: Cache | None = None,
+    scanner: str = 'preprocess',
+    expected_rss: int = 0,
+):
+    '''Runs the compiler to find dependencies of a TU, returning its details,
+    the compiler's peak RSS and its exit code'''
+    dir_ = compilation_command.get('directory') or cc_dir
+
+    q_arguments, arguments = split_arguments(compilation_command['arguments'], vee, dir_)
+
+    # dependencies are written to stdout instead of a file, the preprocessed
+    # source is discarded
+    if scanner == 'preprocess':
+        q_arguments = [q_arguments[0], '-E', '-MD', '-MF-', *q_arguments[1:], '-o', '/dev/null', '-Wno-error']
+    else:
+        q_arguments = [q_arguments[0], '-M', *q_arguments[1:], '-Wno-error']
+    if _admission is not None:
+        _admission.acquire(expected_rss)
+    try:
+        completion, peak_rss = run_measured(
+            q_arguments,
+            cwd=dir_,
+            stdout=PIPE,
+            stderr=PIPE,
+            stdin=DEVNULL,
+            text=True)
+    finally:
+        if _admission is not None:
+            _admission.release(expected_rss)
 
-        dir_ = compilation_command.get('directory') or cc_dir
+    if completion.returncode != 0:
+        # a partial dependency list could miss files that would invalidate it
+        cache = None
 
-        return index, {Path(dir_, f) for f in files}, arguments
+    files = None
+    if completion.stdout.strip():
+        try:
+            files = [f for deps in parse_make_rules(completion.stdout).values() for f in deps]
+        except ValueError as e:
+            print('failed to read dependencies:', completion.stdout, e)
+            return _details_result(index, dir_, compilation_command, vee, None, None, arguments), peak_rss, completion.returncode
     else:
         print('no dependencies recorded for', compilation_command['file'])
+        if completion.returncode != 0:
+            print(completion.stderr)
 
-    if completion.returncode != 0:
-        print(completion.stderr)
-    return index, set(), arguments
+    return _details_result(index, dir_, compilation_command, vee, files, cache, arguments), peak_rss, completion.returncode
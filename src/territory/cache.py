@@ -0,0 +1,72 @@
+from hashlib import blake2b
+from os import environ, getpid, utime
+from pathlib import Path
+from time import time
+import json
+
+from platformdirs import user_cache_path
+
+
+DEFAULT_CACHE_DIR = user_cache_path('Territory')
+MAX_SIZE = 1 << 30
+MAX_AGE = 30 * 24 * 3600
+
+
+def default_cache_dir() -> Path:
+    return Path(environ.get('TERRITORY_CACHE_DIR', DEFAULT_CACHE_DIR))
+
+
+def cache_key(*parts) -> str:
+    return blake2b(json.dumps(parts).encode(), digest_size=20).hexdigest()
+
+
+class Cache:
+    '''Directory of JSON entries that can be shared by concurrent processes'''
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def _entry_path(self, key: str) -> Path:
+        return self.root / key[:2] / (key[2:] + '.json')
+
+    def get(self, key: str):
+        path = self._entry_path(key)
+        try:
+            value = json.loads(path.read_bytes())
+        except (FileNotFoundError, ValueError):
+            return None
+        # mtime is used as the last access time when evicting
+        utime(path)
+        return value
+
+    def put(self, key: str, value):
+        path = self._entry_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{getpid()}.tmp')
+        tmp_path.write_text(json.dumps(value))
+        tmp_path.replace(path)
+
+    def delete(self, key: str):
+        self._entry_path(key).unlink(missing_ok=True)
+
+    def evict(self, max_size: int = MAX_SIZE, max_age: float = MAX_AGE):
+        '''Removes entries not used in max_age seconds, then the least recently
+        used ones until the total size fits in max_size bytes'''
+        now = time()
+        entries = []
+        for path in self.root.glob('*/*.json'):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime > max_age:
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort(reverse=True)
+        total = 0
+        for _mtime, size, path in entries:
+            total += size
+            if total > max_size:
+                path.unlink(missing_ok=True)
@@ -3,19 +3,34 @@ VERSION_STRING = f'territory CLI {__version__}'
 
 
 from argparse import ArgumentParser
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import partial
+from itertools import islice
+from os.path import join
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from threading import Lock, Thread
+from urllib.parse import urlparse
 import logging
-import tarfile
 
-import requests
-import tqdm
-
-from .api_client import DEFAULT_UPLOAD_TOKEN_PATH, auth, create_build_request
-from .git import find_repo_root, list_repo_files, get_sha, get_commit_message, get_branch
+from .api_client import (
+    CONNECT_TIMEOUT, DEFAULT_UPLOAD_TOKEN_PATH, READ_TIMEOUT, ApiClient, auth, create_build_request,
+    find_missing_blobs, stream_upload, upload_file)
+from .cache import Cache, cache_key, default_cache_dir
+from .compression import ARCHIVE_EXTENSIONS, CODECS, open_archive
+from .dedup import Dedup, FileDigests
+from .git import find_repo_root, get_commit_info, iter_repo_files, quote_path
 from . import c, go, python
-from .files import add_path_to_archive
+from .filters import DEFAULT_MAX_SIZE, ContentFilter
+from .files import Archiver, archive_order, file_digest, normalize_tarinfo
+from .incremental import Delta, find_delta, last_upload, save_upload
+from .paths import PathSet
+from .trace import span, tracing
+
+
+# repository files are archived in batches of this many, each sorted by
+# archive_order, as git lists them
+LISTING_BATCH = 4096
 
 
 def main(argv=None):
@@ -37,12 +52,60 @@ class Package:
     work_dir: Path
     temp_dir: Path
     repo_root: Path
-    captured_files: set[Path]
+    captured_files: PathSet
     index_system: bool
     upload_token: str | None
+    cache_dir: Path | None
+    client: ApiClient | None = None
+    archiver: Archiver | None = None
+    delta: Delta | None = None
+    content_filter: ContentFilter | None = None
+    _lock: Lock = field(default_factory=Lock, repr=False)
+
+    def capture(self, paths, ordered=False):
+        '''Records files to be packaged, passing new ones on to the archiver
+
+        Unless ordered, files are archived in sorted order once everything is
+        captured, so the archive does not depend on the discovery order.'''
+        paths = list(paths)
+        with self._lock:
+            new = self.captured_files.update(paths)
+        if ordered:
+            new = paths
+        if self.delta is not None:
+            new = [p for p in new if self.delta.includes(p)]
+        if self.archiver is not None:
+            if ordered:
+                self.archiver.add(new)
+            else:
+                self.archiver.defer(new)
 
 
 def upload(args, cwd):
+    client = ApiClient(
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        compress=args.compress_requests)
+    with client.session, tracing(args.trace) as trace:
+        if trace is not None:
+            client.hooks.append(partial(_trace_request, trace))
+        _upload(args, cwd, client)
+
+
+def _trace_request(trace, method, url, status, start, seconds):
+    trace.record(f'{method} {urlparse(url).path}', 'http', start, seconds, status=status)
+
+
+def _upload(args, cwd, client):
+    if args.stream and args.tarball_only:
+        raise SystemExit('--stream cannot be used with --tarball-only')
+    if args.dedup and args.tarball_only:
+        raise SystemExit('--dedup cannot be used with --tarball-only')
+    if args.incremental and args.tarball_only:
+        raise SystemExit('--incremental cannot be used with --tarball-only')
+    if args.incremental and args.no_cache:
+        raise SystemExit('--incremental cannot be used with --no-cache')
+
     upload_token = None
     if not args.tarball_only:
         upload_token = auth(args.upload_token_path)
@@ -55,18 +118,17 @@ def upload(args, cwd):
     elif args.lang == 'python':
         lang = python.Lang()
     else:
-        lang = c.Lang()
+        lang = c.Lang(scanner=args.c_scanner)
 
     jobs_page_url = None
+    tarball_name = 'territory_upload' + ARCHIVE_EXTENSIONS[args.compression]
 
     with TemporaryDirectory() as td:
         td = Path(td)
-        captured_files: set[Path] = set()
+        captured_files = PathSet()
 
         tfl = Path(td, 'TERRITORY_FILE_LISTING')
-        repo_files = list_repo_files(cwd)
-        tfl.write_text(repo_files)
-        captured_files.update(Path(cwd, p) for p in repo_files.split('\n'))
+        repo_files = iter_repo_files(cwd, recurse_submodules=args.recurse_submodules)
 
         package = Package(
             work_dir=cwd,
@@ -75,53 +137,172 @@ def upload(args, cwd):
             captured_files=captured_files,
             index_system=args.system,
             upload_token=upload_token,
+            cache_dir=None if args.no_cache else default_cache_dir(),
+            client=client,
         )
-        lang.prepare_package(package)
+        with span('language setup'):
+            lang.setup(package)
+        if not args.no_filter:
+            package.content_filter = ContentFilter(
+                repo_root, max_size=int(args.max_file_size * (1 << 20)) or None)
 
-        if args.tarball_only:
-            tarball_in = repo_root
-        else:
-            tarball_in = td
-        tarball_path = Path(tarball_in, 'territory_upload.tar.gz')
-        added = set()
-        with tarfile.open(tarball_path, 'w:gz') as output:
-            output.add(tfl, arcname=repo_root / 'TERRITORY_FILE_LISTING')
-            lang.add_to_tar_file(package, output)
-            for path in tqdm.tqdm(package.captured_files, 'compressing'):
-                if not path.exists():
-                    print('missing file:', path)
-                    continue
-                add_path_to_archive(added, output, path)
+        builds = None
+        if package.cache_dir is not None and not args.tarball_only:
+            builds = Cache(package.cache_dir / 'builds')
+        if args.incremental:
+            # the whole listing is needed to tell tracked files from others
+            repo_files = list(repo_files)
+            tracked = PathSet(captured_files.table, (join(cwd, p) for p in repo_files))
+            with span('find changes'):
+                package.delta = find_delta(
+                    last_upload(builds, args.repo_id, repo_root), repo_root, tracked)
+
+        dedup = None
+        if args.dedup:
+            digests_cache = None
+            if package.cache_dir is not None:
+                digests_cache = Cache(package.cache_dir / 'digests')
+            dedup = Dedup(
+                FileDigests(digests_cache, str(repo_root)),
+                partial(find_missing_blobs, upload_token, args.repo_id, client=client))
+
+        def write_archive(f):
+            _write_archive(f, args.compression, package, lang, tfl, repo_files, dedup)
 
         if args.tarball_only:
+            tarball_path = Path(repo_root, tarball_name)
+            with tarball_path.open('wb') as f, span('archive'):
+                write_archive(f)
             print('created', tarball_path)
             return
 
         print('collecting commit info')
-        branch = str(get_branch(repo_root))
+        with span('commit info'):
+            commit = get_commit_info(repo_root)
+        branch = commit.branch
+        sha = commit.sha
         meta = {
-            'commit': get_sha(repo_root),
-            'commit_message': get_commit_message(repo_root),
+            'commit': sha,
+            'commit_message': commit.message,
             'repo_root': str(repo_root),
             'index_system': args.system,
+            'compression': args.compression,
         }
+        if dedup is not None:
+            meta['dedup'] = True
+        if package.delta is not None:
+            meta['base_commit'] = package.delta.base
         lang.add_to_meta(meta)
 
-        print('registering build request')
-        blob_size = tarball_path.stat().st_size
-        intent = create_build_request(
-            upload_token, args.repo_id, branch, meta, blob_size)
-        jobs_page_url = intent.get('jobsPageUrl')
+        if args.stream:
+            print('registering build request')
+            with span('register build request'):
+                intent = create_build_request(
+                    upload_token, args.repo_id, branch, meta, None, stream=True, client=client)
+            if not intent.get('stream'):
+                raise SystemExit('the server does not accept streamed uploads, try again without --stream')
+            jobs_page_url = intent.get('jobsPageUrl')
+
+            print('uploading')
+            # the archive is written while it is uploaded
+            with span('upload') as info:
+                info['bytes'] = stream_upload(intent, write_archive, client=client)
+
+        else:
+            tarball_path = Path(td, tarball_name)
+            with tarball_path.open('wb') as f, span('archive'):
+                write_archive(f)
+
+            # an identical archive for the same build can resume an interrupted upload
+            uploads = state_key = state = None
+            if package.cache_dir is not None:
+                uploads = Cache(package.cache_dir / 'uploads')
+                state_key = cache_key(
+                    'upload', args.repo_id, branch, meta, file_digest(tarball_path))
+                state = uploads.get(state_key)
 
-        print('uploading')
-        with tarball_path.open('rb') as f:
-            resp = requests.put(intent['url'], data=f, headers=intent['extensionHeaders'])
-        resp.raise_for_status()
+            if state is None:
+                print('registering build request')
+                blob_size = tarball_path.stat().st_size
+                with span('register build request'):
+                    intent = create_build_request(
+                        upload_token, args.repo_id, branch, meta, blob_size, multipart=True,
+                        client=client)
+                state = {'intent': intent, 'parts': {}}
+            jobs_page_url = state['intent'].get('jobsPageUrl')
+
+            def save_progress():
+                uploads.put(state_key, state)
+
+            print('uploading')
+            with span('upload', bytes=tarball_path.stat().st_size):
+                upload_file(
+                    state['intent'],
+                    tarball_path,
+                    state['parts'],
+                    save_progress if uploads is not None else None,
+                    client=client)
+            if uploads is not None:
+                uploads.delete(state_key)
+
+        if builds is not None:
+            save_upload(builds, args.repo_id, repo_root, sha, lang.incremental_state())
 
     if jobs_page_url:
         print(f'Indexing will begin shortly. You can track build status at <{jobs_page_url}>.')
 
 
+def _write_archive(fileobj, codec, package, lang, listing_path, repo_files, dedup=None):
+    with open_archive(fileobj, codec) as output:
+        # files are compressed while the language scanner still runs
+        package.archiver = Archiver(output, dedup=dedup, table=package.captured_files.table)
+        def feed():
+            with span('archive repository files'), listing_path.open('w') as listing:
+                _feed_repo_files(package, repo_files, listing)
+        feeder = Thread(target=feed, name='repo files')
+        feeder.start()
+        try:
+            with span('scan'):
+                lang.prepare_package(package)
+        finally:
+            with span('finish archive'):
+                feeder.join()
+                package.archiver.close()
+        if package.content_filter is not None:
+            package.content_filter.report()
+        output.add(listing_path, arcname=package.repo_root / 'TERRITORY_FILE_LISTING', filter=normalize_tarinfo)
+        lang.add_to_tar_file(package, output)
+
+        if dedup is not None:
+            dedup.close()
+            manifest_path = package.temp_dir / 'TERRITORY_MANIFEST'
+            dedup.write_manifest(manifest_path)
+            output.add(manifest_path, arcname=package.repo_root / 'TERRITORY_MANIFEST', filter=normalize_tarinfo)
+            print(f'{len(dedup.manifest)} files hashed, {dedup.bytes_skipped} bytes already stored')
+
+        if package.delta is not None:
+            delta_path = package.temp_dir / 'TERRITORY_DELTA'
+            package.delta.write(delta_path)
+            output.add(delta_path, arcname=package.repo_root / 'TERRITORY_DELTA', filter=normalize_tarinfo)
+
+
+def _feed_repo_files(package, repo_files, listing):
+    '''Captures repository files the content filter keeps as they are listed,
+    writing the listing of all of them in the format of git ls-files'''
+    repo_files = iter(repo_files)
+    first = True
+    while batch := list(islice(repo_files, LISTING_BATCH)):
+        for path in batch:
+            if not first:
+                listing.write('\n')
+            listing.write(quote_path(path))
+            first = False
+        paths = [join(package.work_dir, p) for p in batch]
+        if package.content_filter is not None:
+            paths = package.content_filter.filter(paths)
+        package.capture(sorted(paths, key=archive_order), ordered=True)
+
+
 def authenticate(args, cwd):
     auth(args.upload_token_path, force_acquire=True)
 
@@ -143,12 +324,73 @@ sp.add_argument(
     '--system',
     action='store_true',
     help='collect system-wide dependencies')
+sp.add_argument(
+    '--c-scanner',
+    choices=c.SCANNERS,
+    default='auto',
+    help='how to discover dependencies of C/C++ files')
+sp.add_argument(
+    '--compression',
+    choices=CODECS,
+    default='gzip',
+    help='archive compression codec')
+sp.add_argument(
+    '--no-cache',
+    action='store_true',
+    help='do not reuse or store compilation details from previous runs')
+sp.add_argument(
+    '--dedup',
+    action='store_true',
+    help='only upload contents of files the server does not have yet')
+sp.add_argument(
+    '--incremental',
+    action='store_true',
+    help='only upload changes since the last successful upload from this machine')
+sp.add_argument(
+    '--stream',
+    action='store_true',
+    help='upload the archive while it is being created, without a temporary file')
+sp.add_argument(
+    '--max-file-size',
+    type=float,
+    default=DEFAULT_MAX_SIZE / (1 << 20),
+    metavar='MIB',
+    help='leave out the content of larger repository files, 0 for no limit')
+sp.add_argument(
+    '--no-filter',
+    action='store_true',
+    help='upload the content of all repository files, including binary, generated and ignored ones')
+sp.add_argument(
+    '--recurse-submodules',
+    action='store_true',
+    help='also upload files of git submodules')
+sp.add_argument(
+    '--connect-timeout',
+    type=float,
+    default=CONNECT_TIMEOUT,
+    metavar='SECONDS',
+    help='give up connecting to the server after this long')
+sp.add_argument(
+    '--read-timeout',
+    type=float,
+    default=READ_TIMEOUT,
+    metavar='SECONDS',
+    help='give up on a request when the server sends nothing for this long')
+sp.add_argument(
+    '--compress-requests',
+    action='store_true',
+    help='send the build metadata gzip-compressed')
+sp.add_argument(
+    '--trace',
+    type=Path,
+    metavar='FILE',
+    help='write a Chrome trace of the upload to FILE and print a summary of where time went')
 repo_or_tarball = sp.add_mutually_exclusive_group(required=True)
 repo_or_tarball.add_argument('--repo-id')
 repo_or_tarball.add_argument(
     '--tarball-only',
     action='store_true',
-    help='do not upload, create territory_upload.tar.gz output only')
+    help='do not upload, create territory_upload.tar.gz (or .tar.zst) output only')
 
 sp = subparsers.add_parser('authenticate')
 sp.set_defaults(func=authenticate)
@@ -0,0 +1,134 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from time import perf_counter
+import struct
+import tarfile
+import zlib
+
+from .trace import active
+
+
+CODECS = ['gzip', 'zstd']
+ARCHIVE_EXTENSIONS = {
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+}
+
+
+@contextmanager
+def open_archive(fileobj, codec: str = 'gzip', threads: int | None = None):
+    '''Opens a tar archive for writing into fileobj, compressed on multiple threads'''
+    trace = active()
+    if trace is not None:
+        fileobj = _CountingWriter(fileobj)
+    if codec == 'zstd':
+        compressed = _zstd_writer(fileobj, threads)
+    elif codec == 'gzip':
+        compressed = ParallelGzipWriter(fileobj, threads=threads)
+    else:
+        raise ValueError(f'unknown codec: {codec}')
+
+    source = compressed if trace is None else _CountingWriter(compressed)
+    start = perf_counter()
+    try:
+        with tarfile.open(fileobj=source, mode='w|') as tar:
+            yield tar
+    finally:
+        compressed.close()
+        if trace is not None:
+            trace.record(
+                'compress', 'compress', start, perf_counter() - start,
+                codec=codec, bytes_in=source.bytes, bytes_out=fileobj.bytes)
+
+
+class _CountingWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes = 0
+
+    def write(self, data) -> int:
+        self.bytes += len(data)
+        return self.fileobj.write(data)
+
+
+def _zstd_writer(fileobj, threads):
+    try:
+        import zstandard
+    except ImportError:
+        raise SystemExit('zstd compression requires the zstandard package: pip install territory[zstd]')
+    compressor = zstandard.ZstdCompressor(level=3, threads=threads or -1)
+    return compressor.stream_writer(fileobj, closefd=False)
+
+
+def _deflate_block(block: bytes, zdict: bytes, level: int, last: bool) -> bytes:
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _traced_deflate_block(trace, block: bytes, zdict: bytes, level: int, last: bool) -> bytes:
+    with trace.span('deflate', 'compress', bytes=len(block)):
+        return _deflate_block(block, zdict, level, last)
+
+
+class ParallelGzipWriter:
+    '''Writes a single gzip stream, deflating blocks of input on a thread pool
+
+    Every block is primed with the last 32 KiB of the preceding one and all
+    but the last end with a sync flush, so the blocks concatenate into one
+    deflate stream readable by any gzip decoder.
+    '''
+
+    def __init__(self, fileobj, level: int = 6, threads: int | None = None, block_size: int = 1 << 20):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        threads = threads or cpu_count()
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='gzip')
+        self._max_pending = 2 * threads
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._zdict = b''
+        self._crc = 0
+        self._size = 0
+        self._closed = False
+        self._trace = active()
+        # magic, deflate, no flags, zero mtime, no extra flags, unknown OS
+        self.fileobj.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def _submit(self, block: bytes, last: bool):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        if self._trace is None:
+            deflated = self._executor.submit(_deflate_block, block, self._zdict, self.level, last)
+        else:
+            deflated = self._executor.submit(
+                _traced_deflate_block, self._trace, block, self._zdict, self.level, last)
+        self._pending.append(deflated)
+        self._zdict = block[-32768:]
+        while len(self._pending) > self._max_pending:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+            self.fileobj.write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown(cancel_futures=True)
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from multiprocessing import cpu_count
+from os.path import realpath
+from pathlib import Path
+from threading import Lock
+import json
+
+from .cache import Cache, cache_key
+
+
+class FileDigests:
+    '''SHA-256 digests of files, remembered between runs by path, size and mtime'''
+
+    def __init__(self, cache: Cache | None = None, scope: str = ''):
+        self._cache = cache
+        self._key = cache_key('sha256', scope)
+        self._entries: dict[str, list] = {}
+        if cache is not None:
+            self._entries = cache.get(self._key) or {}
+
+    def digest(self, path: Path) -> str:
+        st = path.stat()
+        entry = self._entries.get(str(path))
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+
+        h = sha256()
+        with path.open('rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self._entries[str(path)] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def save(self):
+        if self._cache is not None:
+            self._cache.put(self._key, self._entries)
+
+
+class Dedup:
+    '''Leaves contents the server already stores out of the archive
+
+    Every regular file is listed in a manifest mapping its archive member name
+    to its digest; only files whose digest is missing on the server, and which
+    were not already archived under another name, are archived in full.
+    '''
+
+    def __init__(self, digests: FileDigests, find_missing, threads: int | None = None):
+        self.digests = digests
+        self.find_missing = find_missing
+        self.manifest: dict[str, str] = {}
+        self.bytes_skipped = 0
+        self._archived: set[str] = set()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(threads or cpu_count(), thread_name_prefix='digest')
+
+    def omitted(self, paths) -> set[Path]:
+        '''Hashes a batch of captured paths, returning the resolved paths of
+        files whose content does not need to be archived'''
+        files = list({Path(realpath(p)) for p in paths})
+        files = [p for p in files if p.is_file()]
+        digests = list(self._executor.map(self.digests.digest, files))
+        missing = self.find_missing(sorted(set(digests) - self._archived))
+
+        omit = set()
+        with self._lock:
+            for path, digest in zip(files, digests):
+                self.manifest[str(path).lstrip('/')] = digest
+                if digest in missing and digest not in self._archived:
+                    self._archived.add(digest)
+                else:
+                    omit.add(path)
+                    self.bytes_skipped += path.stat().st_size
+        return omit
+
+    def write_manifest(self, path: Path):
+        path.write_text(json.dumps({
+            'algorithm': 'sha256',
+            'files': dict(sorted(self.manifest.items())),
+        }))
+
+    def close(self):
+        self._executor.shutdown()
+        self.digests.save()
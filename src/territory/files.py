@@ -1,6 +1,16 @@
+from hashlib import blake2b
+from os import lstat, readlink
+from os.path import exists, join, split, splitext
 from pathlib import Path
+from queue import Queue
+from stat import S_ISLNK
+from threading import Lock, Thread
 import tarfile
 
+import tqdm
+
+from .paths import PathSet, PathTable
+
 
 def find_in_ancestors(p: Path, f, highest=False):
     found = None
@@ -15,23 +25,153 @@ def find_in_ancestors(p: Path, f, highest=False):
     raise FileNotFoundError()
 
 
-def add_path_to_archive(added: set[Path], archive: tarfile.TarFile, path: Path):
-    '''Adds a file to archive, ensuring symlinks are preserved and paths normalized'''
-    stk = list(path.parts)
-    i = 1
-    while i <= len(stk):
-        p = Path(*stk[:i])
-        if stk[i-1] == '..':
-            stk[i-2 : i] = []
-            i -= 2
-        elif p.is_symlink():
+def file_digest(path: Path) -> str:
+    h = blake2b(digest_size=20)
+    with path.open('rb') as f:
+        while chunk := f.read(1 << 16):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def add_path_to_archive(
+    added,
+    archive: tarfile.TarFile,
+    path: Path | str,
+    omit=(),
+    links: dict[str, str] | None = None,
+):
+    '''Adds a file to archive, ensuring symlinks are preserved and paths normalized
+
+    Files whose resolved path is in omit are recorded as added, but only the
+    directories and symlinks leading to them are archived. links maps the
+    symlinks seen to their targets; when the same links is passed with every
+    call sharing added, paths already added are known not to be symlinks and
+    each directory is only examined once.'''
+    shared = links is not None
+    if links is None:
+        links = {}
+    pending = list(reversed(Path(path).parts))
+    resolved: list[str] = []
+    while pending:
+        part = pending.pop()
+        if part == '..':
+            if resolved:
+                resolved.pop()
+            continue
+
+        p = join(resolved[-1], part) if resolved else part
+        if p in links:
+            target = links[p]
+        elif shared and p in added:
+            target = None
+        else:
+            target = _readlink(p)
+            if target is not None:
+                links[p] = target
+
+        if target is not None:
             if p not in added:
                 added.add(p)
-                archive.add(p)
-            lp = list(p.readlink().parts)
-            stk[i-1:i] = lp
-            i -= 1
-        elif p not in added:
+                archive.add(p, filter=normalize_tarinfo)
+            pending.extend(reversed(Path(target).parts))
+            continue
+
+        resolved.append(p)
+        if p not in added:
             added.add(p)
-            archive.add(p, recursive=False)
-        i += 1
+            if pending or Path(p) not in omit:
+                archive.add(p, recursive=False, filter=normalize_tarinfo)
+
+
+def normalize_tarinfo(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    '''Clears file metadata that would make archives of identical files differ'''
+    info.mtime = 0
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+
+def archive_order(path):
+    '''Sort key placing files of the same directory and type next to each other'''
+    dir_, name = split(path)
+    return dir_, splitext(name)[1], name
+
+
+def _readlink(p: str) -> str | None:
+    try:
+        if S_ISLNK(lstat(p).st_mode):
+            return readlink(p)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+class Archiver:
+    '''Adds paths to an archive on a background thread as they are discovered
+
+    Paths passed to add are archived in the order given, while discovery goes
+    on. Paths passed to defer are archived on close, sorted by archive_order,
+    so the archive does not depend on the order they were discovered in.
+    '''
+
+    def __init__(
+        self,
+        archive: tarfile.TarFile,
+        max_pending: int = 256,
+        batch_size: int = 1024,
+        dedup=None,
+        table: PathTable | None = None,
+    ):
+        self.archive = archive
+        self.dedup = dedup
+        table = table if table is not None else PathTable()
+        self.added = PathSet(table)
+        self.links: dict[str, str] = {}
+        self.error: BaseException | None = None
+        self._batch_size = batch_size
+        self._ordered = PathSet(table)
+        self._deferred = PathSet(table)
+        self._lock = Lock()
+        self._queue: Queue[list[Path | str] | None] = Queue(max_pending)
+        self._progress = tqdm.tqdm(desc='compressing', unit=' files')
+        self._thread = Thread(target=self._run, name='archiver')
+        self._thread.start()
+
+    def add(self, paths):
+        '''Schedules paths to be added, blocking while too many are pending'''
+        paths = list(paths)
+        with self._lock:
+            self._ordered.update(paths)
+        for i in range(0, len(paths), self._batch_size):
+            self._queue.put(paths[i:i+self._batch_size])
+
+    def defer(self, paths):
+        '''Schedules paths to be added on close'''
+        with self._lock:
+            self._deferred.update(paths)
+
+    def close(self):
+        self.add(sorted(self._deferred - self._ordered, key=archive_order))
+        self._queue.put(None)
+        self._thread.join()
+        self._progress.close()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while (paths := self._queue.get()) is not None:
+            if self.error is not None:
+                continue
+            try:
+                existing = []
+                for path in paths:
+                    if exists(path):
+                        existing.append(path)
+                    else:
+                        print('missing file:', path)
+                omit = self.dedup.omitted(existing) if self.dedup is not None else ()
+                for path in existing:
+                    add_path_to_archive(self.added, self.archive, path, omit, self.links)
+            except BaseException as e:
+                self.error = e
+            self._progress.update(len(paths))
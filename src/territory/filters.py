@@ -0,0 +1,144 @@
+from collections import Counter
+from os import fsdecode, fsencode, lstat
+from pathlib import Path
+from stat import S_ISREG
+from subprocess import check_output
+import re
+
+
+IGNORE_FILE = '.territoryignore'
+DEFAULT_MAX_SIZE = 10 << 20
+# git also considers a file binary when its first 8000 bytes contain a NUL
+SNIFF_SIZE = 8000
+LFS_POINTER = b'version https://git-lfs.github.com/spec/'
+GENERATED_ATTRIBUTES = ('linguist-generated', 'linguist-vendored')
+
+
+def _ignore_regex(pattern: str) -> str:
+    '''Translates a gitignore pattern to a regex matching paths relative to
+    the repository root'''
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    out = [] if anchored else ['(?:.*/)?']
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            out.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            out.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and (end := pattern.find(']', i + 2)) != -1:
+            out.append('[' + pattern[i+1:end].replace('\\', '\\\\').replace('!', '^', 1) + ']')
+            i = end + 1
+        else:
+            if pattern[i] == '\\' and i + 1 < len(pattern):
+                i += 1
+            out.append(re.escape(pattern[i]))
+            i += 1
+    # a matching directory excludes everything under it
+    out.append('/.*' if dir_only else '(?:/.*)?')
+    return ''.join(out)
+
+
+def read_ignore_file(path: Path) -> list[tuple[re.Pattern, bool]]:
+    '''Reads gitignore-style patterns as (regex, negated) pairs'''
+    rules = []
+    for line in path.read_text().splitlines():
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negated = line.startswith('!')
+        rules.append((re.compile(_ignore_regex(line.removeprefix('!'))), negated))
+    return rules
+
+
+class ContentFilter:
+    '''Decides which repository files are archived with their content
+
+    Files larger than max_size, binary files, Git LFS pointers, files git
+    attributes mark linguist-generated or linguist-vendored and files matched
+    by the project's ignore file are left out. They are still listed in
+    TERRITORY_FILE_LISTING, and still archived when a translation unit turns
+    out to depend on them.
+    '''
+
+    def __init__(self, repo_root: Path, max_size: int | None = DEFAULT_MAX_SIZE, attributes: bool = True):
+        self.repo_root = str(repo_root)
+        self.max_size = max_size
+        self.attributes = attributes
+        ignore_path = repo_root / IGNORE_FILE
+        self.ignore = read_ignore_file(ignore_path) if ignore_path.is_file() else []
+        self.skipped: Counter[str] = Counter()
+        self.bytes_saved = 0
+
+    def filter(self, paths: list[str]) -> list[str]:
+        '''Returns those of paths, absolute and inside the repository, whose
+        content should be archived'''
+        relative = [p[len(self.repo_root):].lstrip('/') for p in paths]
+        generated = self._generated(relative) if self.attributes else set()
+        kept = []
+        for path, rel in zip(paths, relative):
+            reason, size = self._reason(path, rel, generated)
+            if reason is None:
+                kept.append(path)
+            else:
+                self.skipped[reason] += 1
+                self.bytes_saved += size
+        return kept
+
+    def _reason(self, path: str, rel: str, generated: set[str]) -> tuple[str | None, int]:
+        try:
+            st = lstat(path)
+        except FileNotFoundError:
+            return None, 0
+        # symlinks and the like cost nothing and keep the tree intact
+        if not S_ISREG(st.st_mode):
+            return None, 0
+        if self._ignored(rel):
+            return 'ignored', st.st_size
+        if rel in generated:
+            return 'generated or vendored', st.st_size
+        if self.max_size is not None and st.st_size > self.max_size:
+            return 'too large', st.st_size
+        with open(path, 'rb') as f:
+            head = f.read(SNIFF_SIZE)
+        if head.startswith(LFS_POINTER):
+            return 'LFS pointer', st.st_size
+        if b'\0' in head:
+            return 'binary', st.st_size
+        return None, 0
+
+    def _ignored(self, rel: str) -> bool:
+        ignored = False
+        for regex, negated in self.ignore:
+            if regex.fullmatch(rel):
+                ignored = not negated
+        return ignored
+
+    def _generated(self, relative: list[str]) -> set[str]:
+        out = check_output(
+            ['git', 'check-attr', '-z', '--stdin', *GENERATED_ATTRIBUTES],
+            cwd=self.repo_root,
+            input=b''.join(fsencode(p) + b'\0' for p in relative))
+        fields = out.split(b'\0')
+        return {
+            fsdecode(path)
+            for path, _attr, value in zip(fields[0::3], fields[1::3], fields[2::3])
+            if value in (b'set', b'true')
+        }
+
+    def report(self):
+        if not self.skipped:
+            return
+        reasons = ', '.join(f'{n} {reason}' for reason, n in sorted(self.skipped.items()))
+        print(f'left out the content of {sum(self.skipped.values())} files ({reasons}), '
+              f'{self.bytes_saved / (1 << 20):.1f} MiB saved')
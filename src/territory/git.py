@@ -1,4 +1,7 @@
-from subprocess import check_output
+from dataclasses import dataclass
+from os import fsdecode, fsencode
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, check_output, run
+import re
 
 from .files import find_in_ancestors
 
@@ -11,17 +14,73 @@ def find_repo_root(p):
         raise SystemExit('not a git repository')
 
 
-def list_repo_files(dir):
-    return check_output(['git', 'ls-files'], cwd=dir, text=True).strip()
+def iter_repo_files(dir, recurse_submodules=False, chunk_size=1 << 16):
+    '''Yields paths of files tracked by git, relative to dir, while git is
+    still listing them'''
+    args = ['git', 'ls-files', '-z']
+    if recurse_submodules:
+        args.append('--recurse-submodules')
+    with Popen(args, cwd=dir, stdout=PIPE) as proc:
+        rest = b''
+        while chunk := proc.stdout.read1(chunk_size):
+            *paths, rest = (rest + chunk).split(b'\0')
+            for path in paths:
+                yield fsdecode(path)
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, args)
 
 
-def get_branch(dir):
-    return check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd=dir, text=True).strip()
+_NEEDS_QUOTING = re.compile(r'[\x00-\x1f"\\\x7f-\U0010ffff]')
+_QUOTE_ESCAPES = {
+    0x07: '\\a', 0x08: '\\b', 0x09: '\\t', 0x0a: '\\n', 0x0b: '\\v', 0x0c: '\\f',
+    0x0d: '\\r', 0x22: '\\"', 0x5c: '\\\\',
+}
 
 
-def get_sha(dir) -> str:
-    return check_output(['git', 'rev-parse', 'HEAD'], cwd=dir, text=True).strip()
+def quote_path(path: str) -> str:
+    '''Quotes path the way git ls-files does without -z'''
+    if _NEEDS_QUOTING.search(path) is None:
+        return path
+    return '"' + ''.join(
+        _QUOTE_ESCAPES.get(b) or (chr(b) if 0x20 <= b < 0x7f else f'\\{b:03o}')
+        for b in fsencode(path)
+    ) + '"'
 
 
-def get_commit_message(dir) -> str:
-    return check_output(['git', 'log', '-1', r'--format=%B'], cwd=dir, text=True)
+@dataclass
+class CommitInfo:
+    sha: str
+    branch: str
+    message: str
+
+
+def get_commit_info(dir) -> CommitInfo:
+    '''Reads the HEAD commit and branch with a single git call; the branch is
+    HEAD when detached'''
+    out = check_output(
+        [
+            'git', 'log', '-1', '--decorate-refs=HEAD', '--decorate-refs=refs/heads/',
+            '--format=%H%x00%D%x00%B', 'HEAD',
+        ],
+        cwd=dir, text=True)
+    sha, refs, message = out.split('\0', 2)
+    head = refs.split(', ')[0]
+    branch = head.removeprefix('HEAD -> ') if head.startswith('HEAD -> ') else 'HEAD'
+    return CommitInfo(sha, branch, message)
+
+
+def is_ancestor(dir, commit, descendant='HEAD') -> bool:
+    '''Whether commit is reachable from descendant; False also when commit is unknown'''
+    res = run(
+        ['git', 'merge-base', '--is-ancestor', commit, descendant],
+        cwd=dir, stdout=DEVNULL, stderr=DEVNULL)
+    return res.returncode == 0
+
+
+def diff_name_status(dir, base) -> list[tuple[str, str]]:
+    '''Lists (status, path) of files changed in the working tree since base,
+    with paths relative to the repository root'''
+    out = check_output(
+        ['git', 'diff', '--name-status', '--no-renames', '-z', base], cwd=dir, text=True)
+    fields = out.split('\0')
+    return list(zip(fields[0:-1:2], fields[1::2]))
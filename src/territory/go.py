@@ -1,9 +1,13 @@
-from os import environ
+from os import environ, walk
 from pathlib import Path
 from platform import machine, system
-from subprocess import check_call
+from shutil import copyfile, which
+from subprocess import check_call, check_output
 
-from .api_client import download_resource
+from .api_client import cached_resource
+from .cache import cache_key
+from .files import file_digest, normalize_tarinfo
+from .uim import UimCache
 
 
 MACHINE = machine().lower()
@@ -11,39 +15,69 @@ if MACHINE == 'x86_64':  MACHINE = 'amd64'
 if MACHINE == 'aarch64':  MACHINE = 'arm64'
 SYSTEM = system().lower()
 BINARY_KEY = f'goscan-{SYSTEM}-{MACHINE}'
+# files whose content decides what goscan outputs
+MODULE_FILES = ('go.mod', 'go.sum', 'go.work', 'go.work.sum')
 
 
 class Lang:
-    def prepare_package(self, package):
+    def setup(self, package):
         self.package = package
         self.uim_dir = package.temp_dir / 'uim'
-        self._run_go_scanner(package.repo_root, self.uim_dir, package.index_system)
+
+    def prepare_package(self, package):
+        scanner_path = environ.get('GOSCAN_PATH') or str(self._get_go_scanner())
+        if package.cache_dir is None:
+            self._run_go_scanner(scanner_path, package.repo_root, self.uim_dir, package.index_system)
+            return
+
+        # goscan scans whole modules, so its output is reused only when no
+        # source changed
+        cache = UimCache(package.cache_dir, package.repo_root)
+        key = self._uim_key(cache, scanner_path, package.repo_root, package.index_system)
+        entry = cache.get(key)
+        if entry is not None:
+            print('Go sources unchanged since they were last scanned')
+            cache.restore(entry, self.uim_dir)
+        else:
+            self._run_go_scanner(scanner_path, package.repo_root, self.uim_dir, package.index_system)
+            cache.store(key, self.uim_dir)
+        cache.save()
 
     def add_to_tar_file(self, package, output):
         # for uim in self.uim_dir.glob('*'):
-        output.add(self.uim_dir, arcname=package.repo_root / '.territory/uim')
+        output.add(self.uim_dir, arcname=package.repo_root / '.territory/uim', filter=normalize_tarinfo)
 
     def add_to_meta(self, meta):
         meta['lang'] = 'go'
 
+    def incremental_state(self):
+        return {}
+
     def _get_go_scanner(self):
         print('getting parser binary for platform:', BINARY_KEY)
-        if SYSTEM == 'windows':
-            bin_path = self.package.temp_dir / 'goscan.exe'
-        else:
-            bin_path = self.package.temp_dir / 'goscan'
-        download_resource(
+        bin_path = cached_resource(
             upload_token=self.package.upload_token,
             resource=BINARY_KEY,
-            destination=bin_path)
-        if not SYSTEM == 'windows':
-            bin_path.chmod(0o700)
+            cache_dir=self.package.cache_dir,
+            temp_dir=self.package.temp_dir,
+            client=self.package.client)
+        if SYSTEM == 'windows':
+            # cached without an extension, which Windows needs to run it
+            exe_path = self.package.temp_dir / 'goscan.exe'
+            copyfile(bin_path, exe_path)
+            return exe_path
+        bin_path.chmod(0o700)
         return bin_path
 
-    def _run_go_scanner(self, scan_dir: Path, uim_output_dir: Path, system: bool):
-        scanner_path = environ.get('GOSCAN_PATH')
-        if not scanner_path:
-            scanner_path = str(self._get_go_scanner())
+    def _uim_key(self, cache: UimCache, scanner_path: str, scan_dir: Path, system: bool) -> str:
+        go_version = None
+        if which('go'):
+            go_version = check_output(['go', 'env', 'GOVERSION'], text=True).strip()
+        return cache_key(
+            'go', str(scan_dir), system, file_digest(Path(scanner_path)), go_version,
+            [(str(p), cache.digest(p)) for p in find_sources(scan_dir)])
+
+    def _run_go_scanner(self, scanner_path: str, scan_dir: Path, uim_output_dir: Path, system: bool):
         cmd = [scanner_path]
         if system:
             cmd.append('--system')
@@ -52,3 +86,14 @@ class Lang:
             uim_output_dir
         ])
         check_call(cmd)
+
+
+def find_sources(scan_dir: Path) -> list[Path]:
+    '''Go files and module files in scan_dir, outside hidden directories'''
+    sources = []
+    for dir_, dirs, files in walk(scan_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        sources.extend(
+            Path(dir_, f) for f in sorted(files)
+            if f.endswith('.go') or f in MODULE_FILES)
+    return sources
@@ -0,0 +1,67 @@
+from dataclasses import dataclass
+from os.path import normpath
+from pathlib import Path
+import json
+
+from .cache import Cache, cache_key
+from .git import diff_name_status, is_ancestor
+
+
+@dataclass
+class Delta:
+    '''Changes in the working tree since the last successful upload'''
+    base: str
+    changed: set[Path]
+    deleted: list[str]
+    tracked: set[Path]
+    previous: dict
+
+    def includes(self, path: Path) -> bool:
+        '''Whether the contents of path need to be uploaded again
+
+        Files not tracked by git (system headers, generated sources) are always
+        included, as their history is unknown.
+        '''
+        path = Path(normpath(path))
+        return path in self.changed or path not in self.tracked
+
+    def intersects(self, paths) -> bool:
+        '''Whether any of paths was changed or deleted'''
+        return any(Path(normpath(p)) in self.changed for p in paths)
+
+    def write(self, path: Path):
+        path.write_text(json.dumps({'base': self.base, 'deleted': self.deleted}))
+
+
+def _state_key(repo_id, repo_root) -> str:
+    return cache_key('last-upload', repo_id, str(repo_root))
+
+
+def last_upload(cache: Cache, repo_id, repo_root) -> dict | None:
+    return cache.get(_state_key(repo_id, repo_root))
+
+
+def save_upload(cache: Cache, repo_id, repo_root, commit: str, lang_state: dict):
+    '''Remembers a successful upload as the base of the next incremental one'''
+    cache.put(_state_key(repo_id, repo_root), {'commit': commit, 'lang': lang_state})
+
+
+def find_delta(state: dict | None, repo_root: Path, tracked: set[Path]) -> Delta | None:
+    '''Compares the working tree with the last upload, returning None when a
+    full upload is needed'''
+    if state is None:
+        print('no previous upload recorded, uploading everything')
+        return None
+    base = state['commit']
+    if not is_ancestor(repo_root, base):
+        print(f'previous upload {base[:12]} is not in the history of HEAD, uploading everything')
+        return None
+
+    changed = set()
+    deleted = []
+    for status, path in diff_name_status(repo_root, base):
+        changed.add(Path(repo_root, path))
+        if status == 'D':
+            deleted.append(path)
+    print(f'{len(changed)} files changed and {len(deleted)} deleted since {base[:12]}')
+    return Delta(base, changed, sorted(deleted), tracked, state['lang'])
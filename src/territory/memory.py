@@ -0,0 +1,89 @@
+from multiprocessing import Lock, Value
+from os import wait4, waitstatus_to_exitcode
+from subprocess import CompletedProcess, Popen
+from sys import platform
+from threading import Thread
+from time import perf_counter, sleep
+
+
+MIN_FREE = 1 << 30
+MAX_BACKOFF = 2.0
+
+
+def available_memory() -> int | None:
+    '''Memory available to new processes in bytes, None if unknown'''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_measured(args, **kwargs) -> tuple[CompletedProcess, int]:
+    '''Runs a process like subprocess.run, also returning its peak RSS in bytes
+
+    stdout and stderr may be captured with PIPE; input may not be passed.'''
+    with Popen(args, **kwargs) as proc:
+        stdout = []
+        reader = None
+        if proc.stdout is not None:
+            # drained on a thread so neither pipe can fill up and block the process
+            reader = Thread(target=lambda: stdout.append(proc.stdout.read()))
+            reader.start()
+        stderr = proc.stderr.read() if proc.stderr is not None else None
+        if reader is not None:
+            reader.join()
+        _pid, status, usage = wait4(proc.pid, 0)
+        proc.returncode = waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes everywhere but macOS
+    peak_rss = usage.ru_maxrss if platform == 'darwin' else usage.ru_maxrss * 1024
+    return CompletedProcess(args, proc.returncode, stdout[0] if stdout else None, stderr), peak_rss
+
+
+class Admission:
+    '''Limits processes started by a pool of workers to those expected to fit
+    in available memory
+
+    Every running process holds a reservation of its expected peak RSS until it
+    exits, which is counted on top of what it already uses, so admission errs on
+    the safe side. A process is always admitted when no other is running.
+    '''
+
+    def __init__(self, min_free: int = MIN_FREE):
+        self.min_free = min_free
+        self._lock = Lock()
+        self._running = Value('i', 0, lock=False)
+        self._reserved = Value('q', 0, lock=False)
+        self._waited = Value('d', 0.0, lock=False)
+
+    @property
+    def waited(self) -> float:
+        '''Total seconds processes waited for memory'''
+        return self._waited.value
+
+    def acquire(self, expected_rss: int):
+        '''Blocks, backing off exponentially, until a process expected to peak
+        at expected_rss bytes can start'''
+        start = perf_counter()
+        delay = 0.05
+        while True:
+            with self._lock:
+                available = available_memory()
+                if (
+                    self._running.value == 0 or available is None or
+                    available - self._reserved.value - expected_rss >= self.min_free
+                ):
+                    self._running.value += 1
+                    self._reserved.value += expected_rss
+                    self._waited.value += perf_counter() - start
+                    return
+            sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+
+    def release(self, expected_rss: int):
+        with self._lock:
+            self._running.value -= 1
+            self._reserved.value -= expected_rss
@@ -0,0 +1,138 @@
+from array import array
+from os import fsdecode, fsencode
+from os.path import join, split
+from pathlib import Path
+from threading import Lock
+
+
+class PathTable:
+    '''Interns paths as a directory id and a name id kept in arrays
+
+    Every directory and file name is stored once however many paths share it,
+    so the same headers reported by many translation units cost a few bytes
+    per path once interned.
+    '''
+
+    def __init__(self):
+        self._dirs: list[str] = []
+        self._dir_ids: dict[str, int] = {}
+        self._names: list[str] = []
+        self._name_ids: dict[str, int] = {}
+        self._dir_of = array('I')
+        self._name_of = array('I')
+        self._ids: dict[int, int] = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._dir_of)
+
+    def intern(self, path) -> int:
+        with self._lock:
+            return self._intern(path)
+
+    def intern_all(self, paths) -> list[int]:
+        with self._lock:
+            return [self._intern(p) for p in paths]
+
+    def _intern(self, path) -> int:
+        dir_, name = split(path)
+        dir_id = self._dir_ids.get(dir_)
+        if dir_id is None:
+            dir_id = self._dir_ids[dir_] = len(self._dirs)
+            self._dirs.append(dir_)
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self._names)
+            self._names.append(name)
+
+        key = dir_id << 32 | name_id
+        path_id = self._ids.get(key)
+        if path_id is None:
+            path_id = self._ids[key] = len(self._dir_of)
+            self._dir_of.append(dir_id)
+            self._name_of.append(name_id)
+        return path_id
+
+    def find(self, path) -> int | None:
+        '''Id of path if it was interned'''
+        dir_, name = split(path)
+        dir_id = self._dir_ids.get(dir_)
+        name_id = self._name_ids.get(name)
+        if dir_id is None or name_id is None:
+            return None
+        return self._ids.get(dir_id << 32 | name_id)
+
+    def name(self, path_id: int) -> str:
+        dir_ = self._dirs[self._dir_of[path_id]]
+        name = self._names[self._name_of[path_id]]
+        return join(dir_, name)
+
+    def path(self, path_id: int) -> Path:
+        return Path(self.name(path_id))
+
+
+class PathSet:
+    '''Set of paths interned in a PathTable, kept as a bitmap of their ids'''
+
+    def __init__(self, table: PathTable | None = None, paths=()):
+        self.table = table if table is not None else PathTable()
+        self._bits = bytearray()
+        self._len = 0
+        self.update(paths)
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, path):
+        return self.contains_id(self.table.find(path))
+
+    def contains_id(self, path_id: int | None) -> bool:
+        return path_id is not None and path_id < len(self._bits) and bool(self._bits[path_id])
+
+    def __iter__(self):
+        for path_id in self.ids():
+            yield self.table.path(path_id)
+
+    def __eq__(self, other):
+        if isinstance(other, PathSet) and other.table is self.table:
+            return self._bits.rstrip(b'\0') == other._bits.rstrip(b'\0')
+        return set(self) == set(other)
+
+    def ids(self):
+        return (i for i, bit in enumerate(self._bits) if bit)
+
+    def add(self, path):
+        self.add_ids([self.table.intern(path)])
+
+    def update(self, paths) -> list:
+        '''Adds paths, returning those that were not in the set yet'''
+        paths = list(paths)
+        added = self.add_ids(self.table.intern_all(paths))
+        return [p for p, new in zip(paths, added) if new]
+
+    def add_ids(self, path_ids) -> list[bool]:
+        '''Adds interned paths, returning for each whether it was new'''
+        added = []
+        for path_id in path_ids:
+            if path_id >= len(self._bits):
+                self._bits.extend(bytes(max(path_id + 1, 2 * len(self._bits)) - len(self._bits)))
+            new = not self._bits[path_id]
+            if new:
+                self._bits[path_id] = 1
+                self._len += 1
+            added.append(new)
+        return added
+
+    def __sub__(self, other: 'PathSet') -> 'PathSet':
+        result = PathSet(self.table)
+        result.add_ids(i for i in self.ids() if not other.contains_id(i))
+        return result
+
+
+def pack_paths(paths) -> bytes:
+    '''Joins paths into one blob, much cheaper to pickle than path objects'''
+    return b'\0'.join(fsencode(p) for p in paths)
+
+
+def unpack_paths(blob: bytes) -> list[str]:
+    return [fsdecode(p) for p in blob.split(b'\0')] if blob else []
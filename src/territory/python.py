@@ -1,25 +1,199 @@
+from itertools import groupby
+from multiprocessing import cpu_count, get_context
+from os import environ
 from pathlib import Path
-from subprocess import check_call
+from shutil import copyfileobj, rmtree
+
+from .cache import cache_key
+from .files import normalize_tarinfo
+from .trace import span
+from .uim import UIM_FILES, UimCache, installed_distributions
+
+
+# modules of a directory are scanned in shards of up to this many
+SHARD_SIZE = 64
 
 
 class Lang:
-    def prepare_package(self, package):
+    def setup(self, package):
         self.package = package
         self.uim_dir = package.temp_dir / 'uim'
+
+    def prepare_package(self, package):
         self._run_python_scanner(package.repo_root, self.uim_dir, package.index_system)
 
     def add_to_tar_file(self, package, output):
-        output.add(self.uim_dir, arcname=package.repo_root / '.territory/uim')
+        output.add(self.uim_dir, arcname=package.repo_root / '.territory/uim', filter=normalize_tarinfo)
 
     def add_to_meta(self, meta):
         meta['lang'] = 'python'
 
+    def incremental_state(self):
+        return {}
+
     def _run_python_scanner(self, scan_dir: Path, uim_output_dir: Path, system: bool):
-        cmd = ['python', '-m', 'territory_python_scanner']
-        if system:
-            cmd.append('--system')
-        cmd.extend([
-            str(scan_dir),
-            str(uim_output_dir)
-        ])
-        check_call(cmd)
+        procs = int(environ['CORES']) if 'CORES' in environ else cpu_count()
+        cache = None
+        if self.package.cache_dir is not None:
+            cache = UimCache(self.package.cache_dir, scan_dir)
+        scan_modules(scan_dir, uim_output_dir, system, procs, cache)
+
+
+def find_modules(repo_root: Path) -> list[Path]:
+    '''Python files in repo_root, as the scanner finds and resolves them'''
+    return [p.resolve() for p in repo_root.glob('**/*.py') if 'site-packages' not in p.parts]
+
+
+def plan_shards(modules) -> list[list[Path]]:
+    '''Groups modules by directory in sorted order, splitting directories with
+    more than SHARD_SIZE of them'''
+    shards = []
+    modules = sorted(modules, key=lambda p: (p.parent, p.name))
+    for _dir, group in groupby(modules, key=lambda p: p.parent):
+        group = list(group)
+        shards.extend(group[i:i + SHARD_SIZE] for i in range(0, len(group), SHARD_SIZE))
+    return shards
+
+
+def scan_modules(repo_root: Path, uim_dir: Path, system: bool, procs: int, cache: UimCache | None = None):
+    '''Runs the scanner over shards of the repository's modules, in this
+    process or on procs worker processes, merging their output in uim_dir
+
+    With system, the modules the scanned ones import are scanned in further
+    rounds, each module once. The output only depends on the modules found,
+    not on procs. With a cache, shards whose modules, the modules they refer
+    to and the installed distributions did not change since they were last
+    scanned are not scanned again.'''
+    from territory_python_scanner import __version__ as scanner_version
+
+    shards_dir = uim_dir / 'shards'
+    shards = plan_shards(find_modules(repo_root))
+    scanned = {m for shard in shards for m in shard}
+    scope = [scanner_version, system, installed_distributions()] if cache is not None else None
+    print(f'scanning {len(scanned)} Python modules in {len(shards)} shards')
+
+    outputs = []
+    reused = 0
+    pool = None
+    with span('scan modules', modules=len(scanned)) as info:
+        try:
+            while shards:
+                out_dirs = [shards_dir / str(len(outputs) + n) for n in range(len(shards))]
+                outputs.extend(out_dirs)
+                imported = set()
+                jobs = []
+                keys = {}
+                for shard, out_dir in zip(shards, out_dirs):
+                    if cache is not None:
+                        keys[out_dir] = _shard_key(cache, scope, shard)
+                        entry = _cached_shard(cache, keys[out_dir], out_dir)
+                        if entry is not None:
+                            imported.update(map(Path, entry['refs']))
+                            reused += 1
+                            continue
+                    jobs.append((repo_root, shard, out_dir, system))
+
+                if pool is None and min(procs, len(jobs)) > 1:
+                    # forked workers would share this process's connection to
+                    # the jedi inference subprocess if it ever ran the scanner
+                    info['procs'] = min(procs, len(jobs))
+                    pool = get_context('spawn').Pool(info['procs'])
+                run = pool.imap if pool is not None else map
+                for out_dir, refs in run(_scan_shard, jobs):
+                    imported.update(refs)
+                    if cache is not None:
+                        cache.store(keys[out_dir], out_dir, refs={
+                            str(p): cache.digest(p) for p in sorted(refs)})
+
+                # modules outside the repository are scanned in further
+                # rounds when indexing system dependencies
+                shards = plan_shards(imported - scanned) if system else []
+                scanned.update(imported)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        info['shards'] = len(outputs)
+
+    if reused:
+        print(f'{reused} of {len(outputs)} shards unchanged since they were last scanned')
+    if cache is not None:
+        cache.save()
+    merge_shards(outputs, uim_dir)
+    rmtree(shards_dir, ignore_errors=True)
+
+
+def _shard_key(cache: UimCache, scope: list, shard: list[Path]) -> str:
+    return cache_key('python', scope, [(str(m), cache.digest(m)) for m in shard])
+
+
+def _cached_shard(cache: UimCache, key: str, out_dir: Path) -> dict | None:
+    '''Restores the output of a shard unless a module it refers to changed'''
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    for path, digest in entry['refs'].items():
+        if cache.digest(Path(path)) != digest:
+            return None
+    cache.restore(entry, out_dir)
+    return entry
+
+
+def merge_shards(shard_dirs: list[Path], uim_dir: Path):
+    '''Concatenates the output of shards in order; UIM files are sequences of
+    length-prefixed records, so this is a valid UIM file of all of them'''
+    uim_dir.mkdir(parents=True, exist_ok=True)
+    for name in UIM_FILES:
+        with (uim_dir / name).open('wb') as out:
+            for shard_dir in shard_dirs:
+                with (shard_dir / name).open('rb') as f:
+                    copyfileobj(f, out)
+
+
+class _ShardQueue:
+    '''Stands in for the scanner's queue of modules, handing out the shard's
+    modules in sorted order and collecting the ones they refer to instead of
+    scanning them too'''
+
+    def __init__(self, modules: list[Path], system: bool):
+        self.system = system
+        self.pending = set(modules)
+        self.processed = set()
+        self.imported = set()
+
+    def add_dir(self, dir: Path):
+        pass
+
+    def add_imported(self, p: Path):
+        self.imported.add(Path(p).resolve())
+
+    def add_path(self, p: Path):
+        p = Path(p).resolve()
+        if p not in self.processed:
+            self.pending.add(p)
+
+    def next(self) -> Path:
+        p = min(self.pending)
+        self.pending.remove(p)
+        self.mark_processed(p)
+        return p
+
+    def mark_processed(self, p: Path):
+        self.processed.add(p)
+
+    def __bool__(self):
+        return bool(self.pending)
+
+
+def _scan_shard(job) -> tuple[Path, set[Path]]:
+    repo_root, modules, out_dir, system = job
+    # imported here, so that only uploads of Python projects load jedi
+    from territory_python_scanner import scanner
+
+    out_dir.mkdir(parents=True)
+    queue = _ShardQueue(modules, system)
+    make_queue, scanner.ScanQueue = scanner.ScanQueue, lambda system: queue
+    try:
+        scanner.scan_repo(repo_root, str(out_dir / 'nodes.uim'), str(out_dir / 'search.uim'), system=system)
+    finally:
+        scanner.ScanQueue = make_queue
+    return out_dir, queue.imported
@@ -0,0 +1,97 @@
+from statistics import median
+
+from .cache import Cache, cache_key
+
+
+BATCH_SECONDS = 0.5
+MAX_BATCH = 64
+
+
+class JobHistory:
+    '''Time and peak memory each job took in earlier runs, and the throughput
+    achieved with different numbers of processes'''
+
+    def __init__(self, cache: Cache | None = None, scope: str = ''):
+        self._cache = cache
+        self._key = cache_key('jobs', scope)
+        entry = (cache.get(self._key) if cache is not None else None) or {}
+        self.jobs: dict[str, float] = entry.get('jobs', {})
+        self.peak_rss: dict[str, int] = entry.get('peak_rss', {})
+        self.throughput: dict[str, float] = entry.get('throughput', {})
+        self.measured: dict[str, float] = {}
+        self.measured_rss: dict[str, int] = {}
+        self._typical = median(self.jobs.values()) if self.jobs else None
+        self._largest = max(self.peak_rss.values(), default=0)
+
+    def expected(self, name: str) -> float:
+        '''Expected duration of a job, the median of known ones if it never ran,
+        or BATCH_SECONDS if nothing is known'''
+        seconds = self.jobs.get(name, self._typical)
+        return BATCH_SECONDS if seconds is None else seconds
+
+    def expected_rss(self, name: str) -> int:
+        '''Expected peak RSS of a job in bytes, the largest known one if it
+        never ran, or 0 if nothing is known'''
+        return self.peak_rss.get(name, self._largest)
+
+    def record(self, name: str, seconds: float, peak_rss: int | None = None):
+        self.measured[name] = seconds
+        self.jobs[name] = seconds
+        if peak_rss is not None:
+            self.measured_rss[name] = peak_rss
+            self.peak_rss[name] = peak_rss
+
+    def default_procs(self, candidates: list[int]) -> int:
+        '''Tries each candidate process count once, then keeps the one that
+        finished jobs fastest'''
+        for procs in candidates:
+            if str(procs) not in self.throughput:
+                return procs
+        return max(candidates, key=lambda procs: self.throughput[str(procs)])
+
+    def record_throughput(self, procs: int, jobs: int, seconds: float):
+        # too few jobs to keep every process busy say nothing about throughput
+        if jobs >= 4 * procs and seconds > 0:
+            self.throughput[str(procs)] = jobs / seconds
+
+    def save(self):
+        if self._cache is not None:
+            self._cache.put(self._key, {
+                'jobs': self.jobs,
+                'peak_rss': self.peak_rss,
+                'throughput': self.throughput,
+            })
+
+    def report(self, procs: int, seconds: float):
+        '''Prints the longest job, which bounds how fast the run could have been'''
+        if not self.measured:
+            return
+        name, longest = max(self.measured.items(), key=lambda item: item[1])
+        total = sum(self.measured.values())
+        print(f'critical path: {name} ({longest:.1f}s)')
+        print(f'{len(self.measured)} jobs, {total:.1f}s of work on {procs} processes in {seconds:.1f}s')
+        if self.measured_rss:
+            name, largest = max(self.measured_rss.items(), key=lambda item: item[1])
+            print(f'largest peak RSS: {name} ({largest / (1 << 20):.0f} MiB)')
+
+
+def plan_batches(jobs, expected, target: float = BATCH_SECONDS, max_size: int = MAX_BATCH) -> list[list]:
+    '''Orders jobs longest expected first, grouping cheap ones into batches
+    expected to take about target seconds'''
+    batches = []
+    batch = []
+    batch_seconds = 0.0
+    for job in sorted(jobs, key=expected, reverse=True):
+        seconds = expected(job)
+        if seconds >= target:
+            batches.append([job])
+            continue
+        batch.append(job)
+        batch_seconds += seconds
+        if batch_seconds >= target or len(batch) >= max_size:
+            batches.append(batch)
+            batch = []
+            batch_seconds = 0.0
+    if batch:
+        batches.append(batch)
+    return batches
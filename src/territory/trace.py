@@ -0,0 +1,130 @@
+from contextlib import contextmanager, nullcontext
+from os import getpid
+from pathlib import Path
+from threading import Lock, current_thread, get_native_id
+from time import perf_counter
+import json
+
+
+MiB = 1 << 20
+
+
+class Trace:
+    '''Spans of work in Chrome trace event format, viewable in Perfetto or
+    chrome://tracing
+
+    Timestamps come from perf_counter, which worker processes share on the
+    platforms we run on, so spans they measure can be recorded by the parent.
+    '''
+
+    def __init__(self):
+        self.events: list[dict] = []
+        self._threads: set[tuple[int, int]] = set()
+        self._lock = Lock()
+
+    def record(self, name: str, cat: str, start: float, seconds: float,
+               pid: int | None = None, tid: int | None = None, **args):
+        '''Adds a span measured elsewhere, by default on the calling thread'''
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': seconds * 1e6,
+            'pid': pid or getpid(),
+            'tid': tid or get_native_id(),
+            'args': args,
+        }
+        with self._lock:
+            if tid is None and (event['pid'], event['tid']) not in self._threads:
+                self._threads.add((event['pid'], event['tid']))
+                self.events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': event['pid'], 'tid': event['tid'],
+                    'args': {'name': current_thread().name},
+                })
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, cat: str = 'phase', **args):
+        '''Times the body; the yielded args can be extended while it runs'''
+        start = perf_counter()
+        try:
+            yield args
+        finally:
+            self.record(name, cat, start, perf_counter() - start, **args)
+
+    def spans(self, cat: str) -> list[dict]:
+        with self._lock:
+            return [e for e in self.events if e.get('cat') == cat]
+
+    def write(self, path: Path):
+        with self._lock:
+            events = list(self.events)
+        path.write_text(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+    def summary(self, slowest: int = 10):
+        '''Prints how long each phase took, the slowest compiler runs and the
+        compression and upload throughput'''
+        phases = sorted(self.spans('phase'), key=lambda e: e['ts'])
+        print(f'{"phase":<40} {"seconds":>8}')
+        for e in phases:
+            # indented under the phases it ran within
+            depth = sum(
+                1 for o in phases
+                if o is not e and o['ts'] <= e['ts'] and o['ts'] + o['dur'] >= e['ts'] + e['dur'])
+            print(f'{"  " * depth + e["name"]:<40} {e["dur"] / 1e6:>8.2f}')
+
+        runs = self.spans('compile')
+        if runs:
+            failed = sum(1 for e in runs if e['args'].get('exit_code'))
+            print(f'{len(runs)} compiler runs, {failed} failed, slowest:')
+            for e in sorted(runs, key=lambda e: e['dur'], reverse=True)[:slowest]:
+                print(f'{e["dur"] / 1e6:>8.2f}s  {e["name"]} (exit code {e["args"].get("exit_code")})')
+
+        for e in self.spans('compress'):
+            if e['name'] != 'compress':
+                continue
+            busy = sum(b['dur'] for b in self.spans('compress') if b['name'] == 'deflate') / 1e6
+            bytes_in, bytes_out = e['args']['bytes_in'], e['args']['bytes_out']
+            line = (
+                f'compression: {bytes_in / MiB:.1f} MiB to {bytes_out / MiB:.1f} MiB '
+                f'with {e["args"]["codec"]} in {e["dur"] / 1e6:.2f}s')
+            if busy:
+                line += f', {bytes_in / MiB / busy:.1f} MiB/s per thread'
+            print(line)
+
+        for e in self.spans('phase'):
+            if e['name'] == 'upload' and e['dur']:
+                size = e['args'].get('bytes', 0)
+                print(f'upload: {size / MiB:.1f} MiB in {e["dur"] / 1e6:.2f}s, {size / MiB / (e["dur"] / 1e6):.1f} MiB/s')
+
+
+_trace: Trace | None = None
+
+
+def active() -> Trace | None:
+    return _trace
+
+
+@contextmanager
+def tracing(path: Path | None):
+    '''Records spans while the body runs, writing them to path and printing a
+    summary at the end, even if it fails; does nothing if path is None'''
+    global _trace
+    if path is None:
+        yield None
+        return
+    _trace = Trace()
+    try:
+        yield _trace
+    finally:
+        trace, _trace = _trace, None
+        trace.write(path)
+        trace.summary()
+        print('trace written to', path)
+
+
+def span(name: str, cat: str = 'phase', **args):
+    if _trace is None:
+        return nullcontext(args)
+    return _trace.span(name, cat, **args)
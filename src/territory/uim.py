@@ -0,0 +1,51 @@
+from base64 import b64decode, b64encode
+from importlib.metadata import distributions
+from pathlib import Path
+
+from .cache import Cache, cache_key
+from .dedup import FileDigests
+
+
+UIM_FILES = ('nodes.uim', 'search.uim')
+
+
+class UimCache:
+    '''Scanner output kept between runs, each entry holding the UIM files of
+    a scanned directory along with whatever the scanner needs to know about
+    them'''
+
+    def __init__(self, cache_dir: Path, repo_root: Path):
+        self._cache = Cache(cache_dir / 'uim')
+        self.digests = FileDigests(Cache(cache_dir / 'digests'), f'{repo_root} uim')
+
+    def digest(self, path: Path) -> str | None:
+        try:
+            return self.digests.digest(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def get(self, key: str) -> dict | None:
+        return self._cache.get(key)
+
+    def restore(self, entry: dict, uim_dir: Path):
+        '''Writes the UIM files of an entry to uim_dir'''
+        uim_dir.mkdir(parents=True, exist_ok=True)
+        for name, data in entry['files'].items():
+            (uim_dir / name).write_bytes(b64decode(data))
+
+    def store(self, key: str, uim_dir: Path, **meta):
+        files = {
+            path.name: b64encode(path.read_bytes()).decode()
+            for path in sorted(uim_dir.iterdir()) if path.is_file()
+        }
+        self._cache.put(key, {'files': files, **meta})
+
+    def save(self):
+        self.digests.save()
+        self._cache.evict()
+
+
+def installed_distributions() -> str:
+    '''Key of the versions of all distributions installed for this interpreter'''
+    return cache_key(sorted(
+        (d.metadata['Name'] or '', d.version) for d in distributions()))
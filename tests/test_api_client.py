@@ -0,0 +1,249 @@
+from base64 import b64encode
+from hashlib import md5, sha256
+from threading import Lock, Thread
+from time import sleep
+import gzip
+import json
+import os
+
+from flask import Flask, request
+from werkzeug.serving import make_server
+import pytest
+
+import requests
+
+from territory.api_client import ApiClient, ChecksumMismatch, cached_resource, upload_file
+
+
+PART_SIZE = 1000
+
+
+class PartsServer:
+    def __init__(self):
+        self.parts = {}
+        self.attempts = {}
+        self.failures = {}
+        self.completed = None
+        self.lock = Lock()
+
+
+@pytest.fixture
+def parts_server():
+    app = Flask(__name__)
+    api = PartsServer()
+
+    @app.route('/part/<int:number>', methods=['PUT'])
+    def put_part(number):
+        data = request.data
+        with api.lock:
+            api.attempts[number] = api.attempts.get(number, 0) + 1
+            if api.failures.get(number, 0) > 0:
+                api.failures[number] -= 1
+                return 'try again', 503
+        assert request.headers['x-part'] == str(number)
+        api.parts[number] = data
+        return 'OK', 200, {'ETag': f'"{md5(data).hexdigest()}"'}
+
+    @app.route('/complete', methods=['POST'])
+    def complete():
+        api.completed = request.json
+        return 'OK', 200
+
+    server = make_server('localhost', 0, app, threaded=True)
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+
+    location = f'http://localhost:{server.server_port}'
+    api.intent = {
+        'url': location + '/single',
+        'extensionHeaders': {},
+        'multipart': {
+            'partSize': PART_SIZE,
+            'parts': [
+                {'url': f'{location}/part/{n}', 'headers': {'x-part': str(n)}}
+                for n in range(4)
+            ],
+            'completeUrl': location + '/complete',
+        },
+    }
+    yield api
+
+    server.shutdown()
+
+
+def test_multipart_upload(parts_server, tmp_path):
+    blob = os.urandom(3 * PART_SIZE + 123)
+    path = tmp_path / 'blob'
+    path.write_bytes(blob)
+    parts_server.failures = {1: 2}
+
+    upload_file(parts_server.intent, path, backoff=0)
+
+    assert b''.join(parts_server.parts[n] for n in range(4)) == blob
+    assert parts_server.attempts[1] == 3
+    assert [p['number'] for p in parts_server.completed['parts']] == [0, 1, 2, 3]
+
+
+def test_multipart_upload_resume(parts_server, tmp_path):
+    blob = os.urandom(4 * PART_SIZE)
+    path = tmp_path / 'blob'
+    path.write_bytes(blob)
+    parts_server.failures = {2: 100}
+
+    done = {}
+    saves = []
+    with pytest.raises(Exception):
+        upload_file(parts_server.intent, path, done, lambda: saves.append(dict(done)),
+                    retries=2, backoff=0)
+    assert sorted(done) == ['0', '1', '3']
+    assert len(saves) == 3
+    assert parts_server.completed is None
+
+    parts_server.failures = {}
+    parts_server.attempts = {}
+    upload_file(parts_server.intent, path, done, backoff=0)
+
+    assert parts_server.attempts == {2: 1}
+    assert b''.join(parts_server.parts[n] for n in range(4)) == blob
+    assert parts_server.completed is not None
+
+
+class ResourceServer:
+    def __init__(self):
+        self.content = b'goscan v1'
+        self.downloads = 0
+        self.corrupt = False
+
+
+@pytest.fixture
+def resource_server(monkeypatch):
+    app = Flask(__name__)
+    api = ResourceServer()
+
+    @app.route('/build-resource/<name>')
+    def build_resource(name):
+        assert request.authorization.token == 'testtoken'
+        etag = f'"{md5(api.content).hexdigest()}"'
+        if request.headers.get('If-None-Match') == etag:
+            return '', 304
+        api.downloads += 1
+        digest = b64encode(sha256(api.content).digest()).decode()
+        body = api.content + b'!' if api.corrupt else api.content
+        return body, 200, {'ETag': etag, 'Repr-Digest': f'sha-256=:{digest}:'}
+
+    server = make_server('localhost', 0, app, threaded=True)
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+    monkeypatch.setenv('TERRITORY_UPLOAD_API', f'http://localhost:{server.server_port}')
+    api.stop = server.shutdown
+    yield api
+
+    server.shutdown()
+
+
+def test_cached_resource(resource_server, tmp_path):
+    def fetch():
+        return cached_resource('testtoken', 'goscan-test', tmp_path / 'cache', tmp_path / 'tmp')
+
+    assert fetch().read_bytes() == b'goscan v1'
+    assert fetch().read_bytes() == b'goscan v1'
+    assert resource_server.downloads == 1
+
+    resource_server.content = b'goscan v2'
+    path = fetch()
+    assert path.read_bytes() == b'goscan v2'
+    assert resource_server.downloads == 2
+
+    # a damaged copy is not trusted
+    path.write_bytes(b'garbage')
+    assert fetch().read_bytes() == b'goscan v2'
+    assert resource_server.downloads == 3
+
+    # a download not matching its digest does not replace the cached copy
+    resource_server.content = b'goscan v3'
+    resource_server.corrupt = True
+    with pytest.raises(ChecksumMismatch):
+        fetch()
+    assert path.read_bytes() == b'goscan v2'
+    assert list(path.parent.iterdir()) == [path]
+
+    # offline, the cached copy is used
+    resource_server.stop()
+    assert fetch().read_bytes() == b'goscan v2'
+
+
+def test_resource_without_cache(resource_server, tmp_path):
+    (tmp_path / 'tmp').mkdir()
+    path = cached_resource('testtoken', 'goscan-test', None, tmp_path / 'tmp')
+    assert path.parent == tmp_path / 'tmp'
+    assert path.read_bytes() == b'goscan v1'
+
+
+@pytest.fixture
+def flaky_server():
+    app = Flask(__name__)
+    api = PartsServer()
+
+    @app.route('/status/<int:status>', methods=['GET', 'POST'])
+    def status(status):
+        with api.lock:
+            api.attempts[status] = api.attempts.get(status, 0) + 1
+            if api.attempts[status] <= api.failures.get(status, 0):
+                return 'failed', status
+        return 'OK', 200
+
+    @app.route('/slow')
+    def slow():
+        sleep(0.5)
+        return 'OK', 200
+
+    @app.route('/echo', methods=['POST'])
+    def echo():
+        body = request.get_data()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return {'json': json.loads(body), 'encoding': request.headers.get('Content-Encoding')}
+
+    server = make_server('localhost', 0, app, threaded=True)
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+    api.location = f'http://localhost:{server.server_port}'
+    yield api
+
+    server.shutdown()
+
+
+def test_client_retries(flaky_server):
+    client = ApiClient(retries=3, backoff=0)
+    calls = []
+    client.hooks.append(lambda method, url, status, start, seconds: calls.append((method, status)))
+    flaky_server.failures = {500: 2, 503: 2}
+
+    assert client.request('GET', flaky_server.location + '/status/500').status_code == 200
+    assert calls == [('GET', 500), ('GET', 500), ('GET', 200)]
+    flaky_server.attempts = {}
+    # the server may have acted on a POST that failed
+    assert client.request('POST', flaky_server.location + '/status/500').status_code == 500
+    # but not on one it refused
+    assert client.request('POST', flaky_server.location + '/status/503').status_code == 200
+    assert flaky_server.attempts == {500: 1, 503: 3}
+
+
+def test_client_timeout(flaky_server):
+    client = ApiClient(read_timeout=0.1, retries=2, backoff=0)
+    calls = []
+    client.hooks.append(lambda method, url, status, start, seconds: calls.append(status))
+
+    with pytest.raises(requests.Timeout):
+        client.request('GET', flaky_server.location + '/slow')
+    assert calls == [None, None]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_client_compression(flaky_server, compress):
+    client = ApiClient(compress=compress)
+    body = {'commit': 'abc', 'files': ['a.c'] * 100}
+
+    response = client.request('POST', flaky_server.location + '/echo', json=body, compress=True)
+
+    assert response.json() == {'json': body, 'encoding': 'gzip' if compress else None}
@@ -0,0 +1,30 @@
+from os import utime
+from time import time
+
+from territory.cache import Cache
+
+
+def test_cache_roundtrip(tmp_path):
+    cache = Cache(tmp_path / 'cache')
+    assert cache.get('abcdef') is None
+    cache.put('abcdef', {'deps': ['a.h']})
+    assert cache.get('abcdef') == {'deps': ['a.h']}
+
+
+def test_cache_evict(tmp_path):
+    cache = Cache(tmp_path / 'cache')
+    for i, key in enumerate(['aa01', 'aa02', 'aa03', 'aa04']):
+        cache.put(key, 'x' * 100)
+        t = time() - 100 * (4 - i)
+        utime(cache._entry_path(key), (t, t))
+
+    cache.evict(max_age=350)
+    assert cache.get('aa01') is None
+    assert cache.get('aa02') is not None
+
+    # reading refreshes the entry, so aa03 becomes the least recently used one
+    cache.get('aa02')
+    cache.evict(max_size=250)
+    assert cache.get('aa03') is None
+    assert cache.get('aa02') is not None
+    assert cache.get('aa04') is not None
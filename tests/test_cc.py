@@ -1,4 +1,14 @@
-from territory.c import collect_details, read_compile_commands, remove_arg, parse_vee
+from shutil import which
+from sys import executable
+import json
+
+import pytest
+
+from territory import c
+from territory.cache import Cache
+from territory.c import (
+    Vee, collect_details, parse_make_rules, parse_vee, read_compile_commands, remove_arg,
+    rewrite_arguments)
 from territory_testlib import init_repo
 
 
@@ -31,6 +41,164 @@ def test_collect_details_cc_error(tmp_path):
     assert tmp_path / 'repo/shared.h' not in paths
 
 
+FAKE_SCAN_DEPS = f'''#!{executable}
+import json, subprocess, sys
+db = json.load(open(sys.argv[sys.argv.index('-compilation-database') + 1]))
+for cmd in db:
+    args = cmd['arguments']
+    subprocess.run([args[0], '-M', *args[1:]], cwd=cmd['directory'])
+'''
+
+
+@pytest.mark.parametrize('scanner', ['make-deps', 'clang-scan-deps'])
+def test_collect_details_scanner(tmp_path, monkeypatch, scanner):
+    init_repo(tmp_path / 'repo')
+    td = tmp_path / 't'
+    td.mkdir()
+    if scanner == 'clang-scan-deps':
+        fake = tmp_path / 'clang-scan-deps'
+        fake.write_text(FAKE_SCAN_DEPS)
+        fake.chmod(0o700)
+        monkeypatch.setenv('CLANG_SCAN_DEPS', str(fake))
+
+    cc_data = read_compile_commands(tmp_path / 'repo/compile_commands.json')
+    paths = collect_details(td, tmp_path / 'repo', cc_data, scanner='preprocess')
+    scanned_cc_data = read_compile_commands(tmp_path / 'repo/compile_commands.json')
+    scanned_paths = collect_details(td, tmp_path / 'repo', scanned_cc_data, scanner=scanner)
+    assert scanned_paths == paths
+    assert scanned_cc_data == cc_data
+
+
+def test_iter_compile_commands(tmp_path):
+    commands = [
+        {'directory': '/src', 'file': 'a.c', 'command': 'cc -DX="a b" -c a.c'},
+        {'directory': '/src', 'file': 'b.c', 'arguments': ['cc', '-c', 'b.c'], 'output': 'b.o'},
+    ] * 50
+    cc_path = tmp_path / 'compile_commands.json'
+    cc_path.write_text(json.dumps(commands, indent=4))
+
+    expected = read_compile_commands(cc_path)
+    assert expected[0]['arguments'] == ['cc', '-DX=a b', '-c', 'a.c']
+    assert list(c.iter_compile_commands(cc_path, chunk_size=7)) == expected
+
+    out_path = tmp_path / 'out.json'
+    c.write_compile_commands(out_path, expected)
+    assert json.loads(out_path.read_text()) == expected
+    c.write_compile_commands(out_path, [])
+    assert list(c.iter_compile_commands(out_path)) == []
+
+
+def test_parse_make_rules():
+    assert parse_make_rules(
+        'tu-0: /src/a.c /src/a\\ b.h \\\n'
+        '  /usr/include/stdio.h\n'
+        'tu-1: /src/b.c\n'
+        '/usr/include/stdio.h:\n'
+    ) == {
+        'tu-0': ['/src/a.c', '/src/a b.h', '/usr/include/stdio.h'],
+        'tu-1': ['/src/b.c'],
+        '/usr/include/stdio.h': [],
+    }
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('a.o: /src/a\\ b.h\n', ['/src/a b.h']),
+    ('a.o: /src/cost$$.h\n', ['/src/cost$.h']),
+    ('a.o: /src/\\#1.h\n', ['/src/#1.h']),
+    ('a.o: /src/back\\\\\\ slash.h\n', ['/src/back\\ slash.h']),
+    ('a.o: /src/a.c \\\r\n  /src/b.h\r\n', ['/src/a.c', '/src/b.h']),
+    ('a.o: /src/a.c \\\n\\\n  /src/b.h\n', ['/src/a.c', '/src/b.h']),
+    ('a.o: /src/a.c\t/src/b.h   /src/c.h\n', ['/src/a.c', '/src/b.h', '/src/c.h']),
+    ('C:\\out\\a.o: C:\\src\\a.c C:\\src\\dir\\b.h\n', ['C:\\src\\a.c', 'C:\\src\\dir\\b.h']),
+    ('a.o: /src/a:b.h\n', ['/src/a:b.h']),
+    ('a.o:\n', []),
+])
+def test_parse_make_rules_tricky_paths(text, expected):
+    assert list(parse_make_rules(text).values()) == [expected]
+
+
+def test_parse_make_rules_not_a_rule():
+    with pytest.raises(ValueError):
+        parse_make_rules('a.o /src/a.c\n')
+
+
+@pytest.mark.parametrize('scanner', ['make-deps', 'preprocess'])
+def test_collect_details_tricky_paths(tmp_path, scanner):
+    src = tmp_path / 'src dir'
+    src.mkdir()
+    (src / 'a b.h').write_text('\n')
+    (src / 'cost$.h').write_text('\n')
+    (src / '#1.h').write_text('\n')
+    (src / 'main.c').write_text('#include "a b.h"\n#include "cost$.h"\n#include "#1.h"\n')
+    cc_data = [{
+        'arguments': [which('clang'), '-c', '-o', 'main.o', 'main.c'],
+        'directory': str(src),
+        'file': 'main.c',
+    }]
+    td = tmp_path / 't'
+    td.mkdir()
+
+    paths = collect_details(td, src, cc_data, scanner=scanner)
+    for name in ('main.c', 'a b.h', 'cost$.h', '#1.h'):
+        assert src / name in paths
+    assert not (td / 'deps').exists()
+
+
+def test_collect_details_cached(tmp_path, monkeypatch):
+    init_repo(tmp_path / 'repo')
+    cache = Cache(tmp_path / 'cache')
+    td = tmp_path / 't'
+    td.mkdir()
+
+    cc_data = read_compile_commands(tmp_path / 'repo/compile_commands.json')
+    paths = collect_details(td, tmp_path / 'repo', cc_data, cache)
+
+    def no_run(*args, **kwargs):
+        raise AssertionError('compiler should not run')
+
+    with monkeypatch.context() as m:
+        m.setattr(c, 'run', no_run)
+        m.setattr(c, 'run_measured', no_run)
+        cached_cc_data = read_compile_commands(tmp_path / 'repo/compile_commands.json')
+        cached_paths = collect_details(td, tmp_path / 'repo', cached_cc_data, cache)
+    assert cached_paths == paths
+    assert cached_cc_data == cc_data
+
+    (tmp_path / 'repo/shared.h').write_text('#include "other.h"\n')
+    (tmp_path / 'repo/other.h').write_text('\n')
+    cc_data = read_compile_commands(tmp_path / 'repo/compile_commands.json')
+    paths = collect_details(td, tmp_path / 'repo', cc_data, cache)
+    assert tmp_path / 'repo/other.h' in paths
+
+
+def test_toolchain_probe_groups():
+    def probe(arguments, file='a.c'):
+        return c._toolchain_probe('/src', {'arguments': arguments, 'file': file})
+
+    base = probe(['cc', '-Iinc', '-DX=1', '-c', '-o', 'a.o', 'a.c'])
+    assert base == probe(['cc', '-Iother', '-O2', '-c', '-o', 'b.o', 'b.c'], 'b.c')
+    assert base[1] == ('cc', '-x', 'c', '-E', '-v', '-o', '/dev/null', '/dev/null')
+    assert base != probe(['cc', '-c', 'a.cpp'], 'a.cpp')
+    assert base != probe(['cc', '--target=aarch64-linux-gnu', '-c', 'a.c'])
+    assert base != probe(['cc', '-isystem', 'sys', '-c', 'a.c'])
+    assert base != probe(['cc', '--sysroot=/sysroot', '-c', 'a.c'])
+    assert probe(['c++', '-x', 'c++', '-c', 'a.h'], 'a.h')[1] == \
+        ('c++', '-x', 'c++', '-E', '-v', '-o', '/dev/null', '/dev/null')
+
+
+def test_rewrite_arguments(tmp_path):
+    (tmp_path / 'inc').mkdir()
+    (tmp_path / 'sys').mkdir()
+    vee = Vee(target='x86_64-pc-linux-gnu', angle_bracket_include_paths=['sys', '/usr/include'])
+    arguments = [
+        'cc', '-Iinc', '-I', 'sys', '-Imissing', '-isystem', 'sys', '-MD', '-MF', 'a.d',
+        '-c', '-o', 'a.o', 'a.c']
+    assert rewrite_arguments(arguments, vee, tmp_path) == [
+        'cc', '-nostdinc', '-Iinc', '-Isys', '-I/usr/include',
+        '-target', 'x86_64-pc-linux-gnu', '-c', '-o', 'a.o', 'a.c']
+    assert rewrite_arguments(arguments, Vee(), tmp_path) == arguments
+
+
 def test_remove_arg():
     assert remove_arg(['cc', '-c', '-o', '/foo', 'bar'], '-o', 2, prefix=True) == ['cc', '-c', 'bar']
     assert remove_arg(['cc', '-c', '-o/foo', 'bar'], '-o', 2, prefix=True) == ['cc', '-c', 'bar']
@@ -69,3 +237,72 @@ End of search list.
         '/Applications/Xcode.app/Contents/Developer/Toolchains/XcodeDefault.xctoolchain/usr/include',
         '/Applications/Xcode.app/Contents/Developer/Platforms/MacOSX.platform/Developer/SDKs/MacOSX.sdk/System/Library/Frameworks',
     ]
+
+
+def _reference_rewrite(arguments, vee, dir_):
+    '''Argument rewriting as it was done with one remove_arg pass per flag'''
+    scan = arguments
+    for key, count, prefix in [
+        ('-c', 1, False), ('-M', 1, False), ('-MD', 1, False), ('-MM', 1, False),
+        ('-MMD', 1, False), ('-o', 2, True), ('-MF', 2, True),
+    ]:
+        scan = remove_arg(scan, key, count, prefix=prefix)
+
+    index = arguments[:]
+    if vee.target is not None:
+        index[1:1] = ['-target', vee.target]
+    if vee.angle_bracket_include_paths:
+        user_dirs = []
+        i = 0
+        while i < len(index):
+            arg = index[i]
+            if arg in ('-I', '--include-directory'):
+                user_dirs.extend(index[i+1:i+2])
+                i += 1
+            elif arg.startswith('--include-directory='):
+                user_dirs.append(arg[len('--include-directory='):])
+            elif arg.startswith('-I'):
+                user_dirs.append(arg[2:])
+            i += 1
+        include_paths = c._merge_include_paths(user_dirs, vee.angle_bracket_include_paths, dir_)
+        for key, count, prefix in [
+            ('-I', 2, True), ('--include-directory', 2, False), ('--include-directory=', 1, True),
+            ('-cxx-isystem', 2, True), ('-ibuiltininc', 1, False), ('-iframework', 2, True),
+            ('-iframeworkwithsysroot', 2, True), ('--stdlib++-isystem', 2, True),
+            ('-isystem', 2, True), ('-M', 1, False), ('-MD', 1, False), ('-MM', 1, False),
+            ('-MMD', 1, False), ('-MF', 2, True),
+        ]:
+            index = remove_arg(index, key, count, prefix=prefix)
+        index[1:1] = ['-nostdinc', *(f'-I{d}' for d in include_paths)]
+    return scan, index
+
+
+ARGUMENTS_CORPUS = [
+    'cc -c a.c',
+    'cc -c -o a.o a.c',
+    'cc -oa.o -c a.c -Wall',
+    '/usr/bin/c++ -DFOO=1 -Iinc -I inc2 -isystem sys -isystemsys2 -O2 -std=c++17 -o out/a.o -c src/a.cc',
+    'clang++ -MD -MT out/a.o -MF out/a.o.d -Iinc -c a.cc -o a.o',
+    'clang -MMD -MFdeps/a.d -MM -M --include-directory inc --include-directory=inc2 -c a.c',
+    'gcc -cxx-isystem cxx -cxx-isystemcxx2 -ibuiltininc -iframework fw -iframeworkfw2 -c a.c',
+    'clang -iframeworkwithsysroot fws -F fw --stdlib++-isystem lib --stdlib++-isystemlib2 -c a.c',
+    'clang -I -Iinc -I inc -I missing -Iinc -c a.c',
+    'clang --target=aarch64-linux-gnu --sysroot=/sysroot -idirafter after -iquote q -include pre.h -c a.c',
+    'cl -Xclang -MF -Xclang x.d -c a.c -o',
+    'g++ -x c++-header -c a.h -o a.h.gch -MF',
+    ' '.join(['clang++', *(f'-I{i % 7 and "inc" or "missing"}{i}' for i in range(200)),
+              *(f'-DDEF{i}={i}' for i in range(200)), '-c', 'big.cc', '-o', 'big.o']),
+]
+
+
+@pytest.mark.parametrize('command', ARGUMENTS_CORPUS)
+def test_split_arguments_corpus(tmp_path, command):
+    for d in ['inc', 'inc2', 'sys', *(f'inc{i}' for i in range(200))]:
+        (tmp_path / d).mkdir(exist_ok=True)
+    arguments = command.split()
+    for vee in [
+        Vee(),
+        Vee(target='x86_64-pc-linux-gnu'),
+        Vee(target='x86_64-pc-linux-gnu', angle_bracket_include_paths=['sys', '/usr/include']),
+    ]:
+        assert c.split_arguments(arguments, vee, tmp_path) == _reference_rewrite(arguments, vee, tmp_path)
@@ -1,13 +1,17 @@
+from hashlib import sha256
 from io import BytesIO
+import json
 from pathlib import Path
+from subprocess import check_call, check_output
 from threading import Thread
 from unittest.mock import ANY
-from wsgiref.simple_server import make_server
 import tarfile
 
 from flask import Flask, request
+from werkzeug.serving import make_server
 import pytest
 
+from territory.api_client import stream_upload
 from territory.cli import main
 from territory_testlib import init_repo
 
@@ -52,6 +56,7 @@ BUILD_REQUESTS = {
             'repo_root': ANY,
             'compile_commands_dir': ANY,
             'index_system': False,
+            'compression': 'gzip',
             'lang': 'c',
         },
     },
@@ -64,6 +69,7 @@ BUILD_REQUESTS = {
             'commit_message': 'initial commit\n\n',
             'repo_root': ANY,
             'index_system': False,
+            'compression': 'gzip',
             'lang': 'go',
         },
     },
@@ -76,6 +82,7 @@ BUILD_REQUESTS = {
             'commit_message': 'initial commit\n\n',
             'repo_root': ANY,
             'index_system': False,
+            'compression': 'gzip',
             'lang': 'python',
         },
     },
@@ -88,10 +95,14 @@ def test_upload(mock_authserver, monkeypatch, tmp_path, lang):
         'TERRITORY_AUTHORIZER',
         f'{mock_authserver.location}/static/authorize.html')
     monkeypatch.setenv('TERRITORY_UPLOAD_API', mock_authserver.location)
+    monkeypatch.setenv('TERRITORY_CACHE_DIR', str(tmp_path / 'cache'))
     repo_path = tmp_path / 'repo'
     init_repo(repo_path, lang=lang)
 
-    mock_authserver.expected_build_request = BUILD_REQUESTS[lang]
+    mock_authserver.expected_build_request = {
+        **BUILD_REQUESTS[lang],
+        'multipart': True,
+    }
 
     main([
         '-C', str(repo_path),
@@ -117,7 +128,147 @@ def test_upload(mock_authserver, monkeypatch, tmp_path, lang):
 
 
 @pytest.mark.parametrize('lang', ['c', 'go', 'python'])
-def test_tarball_only(tmp_path, lang):
+def test_upload_stream(mock_authserver, monkeypatch, tmp_path, lang):
+    monkeypatch.setenv(
+        'TERRITORY_AUTHORIZER',
+        f'{mock_authserver.location}/static/authorize.html')
+    monkeypatch.setenv('TERRITORY_UPLOAD_API', mock_authserver.location)
+    monkeypatch.setenv('TERRITORY_CACHE_DIR', str(tmp_path / 'cache'))
+    repo_path = tmp_path / 'repo'
+    init_repo(repo_path, lang=lang)
+
+    mock_authserver.expected_build_request = {
+        **BUILD_REQUESTS[lang],
+        'len': None,
+        'stream': True,
+    }
+
+    main([
+        '-C', str(repo_path),
+        'upload',
+        '--upload-token-path', str(tmp_path / 'upload_token'),
+        '--repo-id', 'test_repo_id',
+        '-l', lang,
+        '--stream',
+    ])
+
+    upload, = mock_authserver.uploaded
+    assert mock_authserver.chunked
+    with tarfile.open(fileobj=BytesIO(upload), mode='r:gz') as tf:
+        assert sorted(tf.getnames()) == sorted([
+            str(repo_path / f).lstrip('/')
+            for f in TEST_REPO_EXPECTED_FILES[lang]
+        ] + [
+            str(p).lstrip('/')
+            for p in list(repo_path.parents) + [repo_path]
+        ])
+
+
+def test_upload_dedup(mock_authserver, monkeypatch, tmp_path):
+    monkeypatch.setenv(
+        'TERRITORY_AUTHORIZER',
+        f'{mock_authserver.location}/static/authorize.html')
+    monkeypatch.setenv('TERRITORY_UPLOAD_API', mock_authserver.location)
+    monkeypatch.setenv('TERRITORY_CACHE_DIR', str(tmp_path / 'cache'))
+    repo_path = tmp_path / 'repo'
+    init_repo(repo_path, lang='c')
+
+    shared_digest = sha256((repo_path / 'shared.h').read_bytes()).hexdigest()
+    mock_authserver.stored_digests = {shared_digest}
+    mock_authserver.expected_build_request = {
+        **BUILD_REQUESTS['c'],
+        'meta': {**BUILD_REQUESTS['c']['meta'], 'dedup': True},
+        'multipart': True,
+    }
+
+    main([
+        '-C', str(repo_path),
+        'upload',
+        '--upload-token-path', str(tmp_path / 'upload_token'),
+        '--repo-id', 'test_repo_id',
+        '-l', 'c',
+        '--dedup',
+    ])
+
+    upload, = mock_authserver.uploaded
+    with tarfile.open(fileobj=BytesIO(upload), mode='r:gz') as tf:
+        names = tf.getnames()
+        manifest = json.load(tf.extractfile(str(repo_path / 'TERRITORY_MANIFEST').lstrip('/')))
+    assert str(repo_path / 'mod1.c').lstrip('/') in names
+    assert str(repo_path / 'shared.h').lstrip('/') not in names
+    assert manifest['files'][str(repo_path / 'shared.h').lstrip('/')] == shared_digest
+    assert str(repo_path / 'mod1.c').lstrip('/') in manifest['files']
+
+
+def test_upload_incremental(mock_authserver, monkeypatch, tmp_path):
+    monkeypatch.setenv(
+        'TERRITORY_AUTHORIZER',
+        f'{mock_authserver.location}/static/authorize.html')
+    monkeypatch.setenv('TERRITORY_UPLOAD_API', mock_authserver.location)
+    monkeypatch.setenv('TERRITORY_CACHE_DIR', str(tmp_path / 'cache'))
+    repo_path = tmp_path / 'repo'
+    init_repo(repo_path, lang='c')
+    args = [
+        '-C', str(repo_path),
+        'upload',
+        '--upload-token-path', str(tmp_path / 'upload_token'),
+        '--repo-id', 'test_repo_id',
+        '-l', 'c',
+        '--incremental',
+    ]
+
+    # nothing uploaded before, everything is sent
+    mock_authserver.expected_build_request = {**BUILD_REQUESTS['c'], 'multipart': True}
+    main(args)
+    base = check_output(['git', '-C', repo_path, 'rev-parse', 'HEAD'], text=True).strip()
+
+    with (repo_path / 'mod1.c').open('a') as f:
+        f.write('int qux() { return 0; }\n')
+    check_call(['git', '-C', repo_path, 'rm', '-q', 'Makefile'])
+    check_call(['git', '-C', repo_path, 'commit', '-qam', 'second commit'])
+
+    mock_authserver.expected_build_request = {
+        **BUILD_REQUESTS['c'],
+        'meta': {
+            **BUILD_REQUESTS['c']['meta'],
+            'commit_message': 'second commit\n\n',
+            'base_commit': base,
+        },
+        'multipart': True,
+    }
+    main(args)
+
+    _full, upload = mock_authserver.uploaded
+    with tarfile.open(fileobj=BytesIO(upload), mode='r:gz') as tf:
+        names = tf.getnames()
+        delta = json.load(tf.extractfile(str(repo_path / 'TERRITORY_DELTA').lstrip('/')))
+        ccs = json.load(tf.extractfile(str(repo_path / 'compile_commands.json').lstrip('/')))
+    assert str(repo_path / 'mod1.c').lstrip('/') in names
+    assert str(repo_path / 'shared.h').lstrip('/') not in names
+    assert str(repo_path / 'dir/mod2.c').lstrip('/') not in names
+    assert delta == {'base': base, 'deleted': ['Makefile']}
+    assert [cmd['file'] for cmd in ccs] == [str(repo_path / 'mod1.c')]
+
+
+def test_upload_stream_failure(mock_authserver):
+    mock_authserver.len = None
+    intent = {
+        'url': mock_authserver.location + '/upload',
+        'extensionHeaders': {'x-some-header': 'foo'},
+    }
+
+    def write(f):
+        f.write(b'partial archive')
+        raise RuntimeError('scan failed')
+
+    with pytest.raises(RuntimeError, match='scan failed'):
+        stream_upload(intent, write)
+    assert mock_authserver.uploaded == []
+
+
+@pytest.mark.parametrize('lang', ['c', 'go', 'python'])
+def test_tarball_only(monkeypatch, tmp_path, lang):
+    monkeypatch.setenv('TERRITORY_CACHE_DIR', str(tmp_path / 'cache'))
     repo_path = tmp_path / 'repo'
     init_repo(repo_path, lang=lang)
 
@@ -142,11 +293,100 @@ def test_tarball_only(tmp_path, lang):
             ])
 
 
+def test_tarball_reproducible(monkeypatch, tmp_path):
+    monkeypatch.setenv('TERRITORY_CACHE_DIR', str(tmp_path / 'cache'))
+    repo_path = tmp_path / 'repo'
+    init_repo(repo_path, lang='c')
+    args = [
+        '-C', str(repo_path),
+        'upload',
+        '--upload-token-path', str(tmp_path / 'upload_token'),
+        '--tarball-only',
+        '-l', 'c',
+    ]
+    tarball_path = repo_path / 'territory_upload.tar.gz'
+
+    main(args)
+    first = tarball_path.read_bytes()
+    (repo_path / 'shared.h').touch()
+    main(args + ['--no-cache'])
+
+    assert tarball_path.read_bytes() == first
+    with tarfile.open(tarball_path) as tf:
+        members = tf.getmembers()
+    assert {(m.mtime, m.uid, m.gid, m.uname, m.gname) for m in members} == {(0, 0, 0, '', '')}
+
+
+def test_tarball_content_filter(monkeypatch, tmp_path, capsys):
+    monkeypatch.setenv('TERRITORY_CACHE_DIR', str(tmp_path / 'cache'))
+    repo_path = tmp_path / 'repo'
+    init_repo(repo_path, lang='c')
+    (repo_path / 'logo.png').write_bytes(b'\x89PNG\r\n\x1a\n\0\0\0\rIHDR')
+    (repo_path / 'gen').mkdir()
+    (repo_path / 'gen/table.h').write_text('int table[] = {1, 2, 3};\n')
+    (repo_path / 'gen/unused.h').write_text('\n')
+    (repo_path / '.gitattributes').write_text('gen/** linguist-generated\n')
+    (repo_path / 'mod1.c').write_text('#include "gen/table.h"\n' + (repo_path / 'mod1.c').read_text())
+    check_call(['git', '-C', repo_path, 'add', '.'])
+    check_call(['git', '-C', repo_path, 'commit', '-qm', 'assets'])
+
+    main([
+        '-C', str(repo_path),
+        'upload',
+        '--upload-token-path', str(tmp_path / 'upload_token'),
+        '--tarball-only',
+        '-l', 'c',
+    ])
+
+    with tarfile.open(repo_path / 'territory_upload.tar.gz') as tf:
+        names = tf.getnames()
+        listing = tf.extractfile(str(repo_path / 'TERRITORY_FILE_LISTING').lstrip('/')).read().decode()
+    assert str(repo_path / 'logo.png').lstrip('/') not in names
+    assert str(repo_path / 'gen/unused.h').lstrip('/') not in names
+    # generated, but needed to compile a TU
+    assert str(repo_path / 'gen/table.h').lstrip('/') in names
+    assert {'logo.png', 'gen/table.h', 'gen/unused.h'} <= set(listing.split('\n'))
+    assert 'left out the content of 3 files (1 binary, 2 generated or vendored)' in capsys.readouterr().out
+
+
+def test_tarball_trace(monkeypatch, tmp_path, capsys):
+    monkeypatch.setenv('TERRITORY_CACHE_DIR', str(tmp_path / 'cache'))
+    repo_path = tmp_path / 'repo'
+    init_repo(repo_path, lang='c')
+
+    main([
+        '-C', str(repo_path),
+        'upload',
+        '--upload-token-path', str(tmp_path / 'upload_token'),
+        '--tarball-only',
+        '-l', 'c',
+        '--trace', str(tmp_path / 'trace.json'),
+    ])
+
+    events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+    spans = {}
+    for e in events:
+        if e['ph'] == 'X':
+            spans.setdefault(e['cat'], []).append(e)
+    assert {'archive repository files', 'archive', 'scan', 'run compilers'} <= {e['name'] for e in spans['phase']}
+    assert sorted(e['name'] for e in spans['compile']) == [
+        str(repo_path / 'dir/mod2.c'), str(repo_path / 'mod1.c')]
+    assert {e['args']['exit_code'] for e in spans['compile']} == {0}
+    compress, = [e for e in spans['compress'] if e['name'] == 'compress']
+    assert compress['args']['bytes_out'] == (repo_path / 'territory_upload.tar.gz').stat().st_size
+
+    out = capsys.readouterr().out
+    assert '2 compiler runs, 0 failed' in out
+    assert 'compression:' in out
+
+
 class ApiMock:
     def __init__(self):
         self.upload_intent_created = False
         self.uploaded = []
         self.len = None
+        self.chunked = False
+        self.stored_digests = set()
         self.expected_build_request = {
             'repo_id': 'test_repo_id',
             'branch': 'main',
@@ -157,6 +397,7 @@ class ApiMock:
                 'repo_root': ANY,
                 'compile_commands_dir': ANY,
                 'index_system': False,
+                'compression': 'gzip',
                 'lang': 'c',
             },
         }
@@ -184,12 +425,23 @@ def mock_authserver():
                 'x-some-header': 'foo',
             }
         }
+        if request.json.get('stream'):
+            response['stream'] = True
         return response, 200, {'Content-Type': 'text/plain'}
 
+    @app.route('/blobs/missing', methods=['POST'])
+    def find_missing_blobs():
+        assert request.authorization.token == 'testtoken'
+        assert request.json['repo_id'] == 'test_repo_id'
+        return {'missing': [d for d in request.json['digests'] if d not in api.stored_digests]}
+
     @app.route('/upload', methods=['PUT'])
     def upload():
         api.uploaded.append(request.data)
-        assert len(request.data) == api.len
+        if api.len is None:
+            api.chunked = request.headers.get('Transfer-Encoding') == 'chunked'
+        else:
+            assert len(request.data) == api.len
         assert request.headers['x-some-header'] == 'foo'
         return 'OK', 201
 
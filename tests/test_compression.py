@@ -0,0 +1,46 @@
+from io import BytesIO
+import gzip
+import os
+import tarfile
+
+import pytest
+
+from territory.compression import ParallelGzipWriter, open_archive
+
+
+def test_parallel_gzip_single_stream():
+    data = os.urandom(5000) + b'territory ' * 50000 + os.urandom(3000)
+    out = BytesIO()
+    writer = ParallelGzipWriter(out, threads=3, block_size=4096)
+    for i in range(0, len(data), 1000):
+        writer.write(data[i:i+1000])
+    writer.close()
+
+    assert gzip.decompress(out.getvalue()) == data
+    # priming blocks with their predecessor keeps repetitive input small
+    assert len(out.getvalue()) < 20000
+
+
+def test_parallel_gzip_empty():
+    out = BytesIO()
+    ParallelGzipWriter(out).close()
+    assert gzip.decompress(out.getvalue()) == b''
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'zstd'])
+def test_open_archive(tmp_path, codec):
+    if codec == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+    (tmp_path / 'f').write_bytes(b'f' * 100000)
+
+    out = BytesIO()
+    with open_archive(out, codec, threads=2) as tar:
+        tar.add(tmp_path / 'f', arcname='f')
+
+    data = out.getvalue()
+    if codec == 'zstd':
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    else:
+        data = gzip.decompress(data)
+    with tarfile.open(fileobj=BytesIO(data)) as tar:
+        assert tar.extractfile('f').read() == b'f' * 100000
@@ -0,0 +1,34 @@
+from hashlib import sha256
+
+from territory.cache import Cache
+from territory.dedup import Dedup, FileDigests
+
+
+def test_file_digests_cached(tmp_path, monkeypatch):
+    f = tmp_path / 'f'
+    f.write_text('f')
+    cache = Cache(tmp_path / 'cache')
+
+    digests = FileDigests(cache, 'scope')
+    assert digests.digest(f) == sha256(b'f').hexdigest()
+    digests.save()
+
+    # a cached digest is trusted while size and mtime match
+    reloaded = FileDigests(cache, 'scope')
+    monkeypatch.setattr('territory.dedup.sha256', None)
+    assert reloaded.digest(f) == sha256(b'f').hexdigest()
+
+
+def test_dedup_omits_stored_and_repeated_contents(tmp_path):
+    for name, content in [('a', 'stored'), ('b', 'new'), ('c', 'new'), ('d', 'other')]:
+        (tmp_path / name).write_text(content)
+    stored = {sha256(b'stored').hexdigest()}
+
+    dedup = Dedup(FileDigests(), lambda digests: set(digests) - stored)
+    omit = dedup.omitted([tmp_path / 'a', tmp_path / 'b'])
+    omit |= dedup.omitted([tmp_path / 'c', tmp_path / 'd'])
+    dedup.close()
+
+    assert omit == {tmp_path / 'a', tmp_path / 'c'}
+    assert len(dedup.manifest) == 4
+    assert dedup.bytes_skipped == len('stored') + len('new')
@@ -0,0 +1,61 @@
+from subprocess import check_call
+import re
+
+import pytest
+
+from territory.filters import ContentFilter, IGNORE_FILE, LFS_POINTER, _ignore_regex
+from territory_testlib import init_repo
+
+
+@pytest.mark.parametrize('pattern, path, matches', [
+    ('*.png', 'a.png', True),
+    ('*.png', 'assets/icons/a.png', True),
+    ('*.png', 'a.png.c', False),
+    ('/build', 'build/out.c', True),
+    ('/build', 'src/build/out.c', False),
+    ('data/', 'data/x.csv', True),
+    ('data/', 'src/data/x.csv', True),
+    ('data/', 'data', False),
+    ('docs/*.md', 'docs/a.md', True),
+    ('docs/*.md', 'docs/sub/a.md', False),
+    ('docs/**/*.md', 'docs/sub/deep/a.md', True),
+    ('**/fixtures', 'tests/unit/fixtures/big.json', True),
+    ('file?.bin', 'file1.bin', True),
+    ('file[0-9].bin', 'filex.bin', False),
+    ('\\#notes', '#notes', True),
+])
+def test_ignore_patterns(pattern, path, matches):
+    assert bool(re.fullmatch(_ignore_regex(pattern), path)) == matches
+
+
+def test_content_filter(tmp_path):
+    repo = tmp_path / 'repo'
+    init_repo(repo)
+    (repo / 'big.c').write_text('int x;\n' * 1000)
+    (repo / 'image.png').write_bytes(b'\x89PNG\r\n\x1a\n\0\0\0\rIHDR')
+    (repo / 'model.bin').write_bytes(LFS_POINTER + b'v1\noid sha256:abc\nsize 123456789\n')
+    (repo / 'gen').mkdir()
+    (repo / 'gen/parser.c').write_text('int parse;\n')
+    (repo / 'third_party').mkdir()
+    (repo / 'third_party/lib.c').write_text('int lib;\n')
+    (repo / '.gitattributes').write_text(
+        'gen/** linguist-generated\nthird_party/** linguist-vendored=true\n')
+    (repo / IGNORE_FILE).write_text('# fixtures\n/data/\n*.csv\n!keep.csv\n')
+    (repo / 'data').mkdir()
+    (repo / 'data/table.txt').write_text('1,2\n')
+    (repo / 'a.csv').write_text('1,2\n')
+    (repo / 'keep.csv').write_text('1,2\n')
+    check_call(['git', '-C', repo, 'add', '.'])
+
+    f = ContentFilter(repo, max_size=4096)
+    paths = [str(repo / p) for p in [
+        'mod1.c', 'big.c', 'image.png', 'model.bin', 'gen/parser.c', 'third_party/lib.c',
+        'data/table.txt', 'a.csv', 'keep.csv', 'missing.c']]
+    assert f.filter(paths) == [str(repo / 'mod1.c'), str(repo / 'keep.csv'), str(repo / 'missing.c')]
+    assert f.skipped == {
+        'too large': 1, 'binary': 1, 'LFS pointer': 1, 'generated or vendored': 2, 'ignored': 2}
+    assert f.bytes_saved == sum((repo / p).stat().st_size for p in [
+        'big.c', 'image.png', 'model.bin', 'gen/parser.c', 'third_party/lib.c', 'data/table.txt', 'a.csv'])
+
+    assert ContentFilter(repo, max_size=None, attributes=False).filter([str(repo / 'big.c'), str(repo / 'gen/parser.c')]) == \
+        [str(repo / 'big.c'), str(repo / 'gen/parser.c')]
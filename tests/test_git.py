@@ -0,0 +1,43 @@
+from subprocess import check_call, check_output
+
+from territory.git import get_commit_info, iter_repo_files, quote_path
+from territory_testlib import init_repo
+
+
+TRICKY_NAMES = ['with space.c', 'new\nline.c', 'quote".h', 'back\\slash.h', 'tab\t.h', 'zażółć.c', 'bell\a.h']
+
+
+def test_iter_repo_files(tmp_path):
+    init_repo(tmp_path / 'repo')
+    for name in TRICKY_NAMES:
+        (tmp_path / 'repo' / name).write_text('\n')
+    check_call(['git', '-C', tmp_path / 'repo', 'add', '.'])
+
+    files = list(iter_repo_files(tmp_path / 'repo', chunk_size=5))
+    assert set(TRICKY_NAMES) <= set(files)
+    assert 'dir/mod2.c' in files
+    # the listing keeps the format of git ls-files
+    assert '\n'.join(quote_path(f) for f in files) == \
+        check_output(['git', 'ls-files'], cwd=tmp_path / 'repo', text=True).strip()
+
+
+def test_iter_repo_files_submodules(tmp_path):
+    init_repo(tmp_path / 'sub')
+    init_repo(tmp_path / 'repo')
+    check_call([
+        'git', '-C', tmp_path / 'repo', '-c', 'protocol.file.allow=always',
+        'submodule', 'add', '-q', tmp_path / 'sub', 'vendor/sub'])
+
+    assert 'vendor/sub/mod1.c' not in set(iter_repo_files(tmp_path / 'repo'))
+    assert 'vendor/sub/mod1.c' in set(iter_repo_files(tmp_path / 'repo', recurse_submodules=True))
+
+
+def test_get_commit_info(tmp_path):
+    init_repo(tmp_path / 'repo')
+    sha = check_output(['git', '-C', tmp_path / 'repo', 'rev-parse', 'HEAD'], text=True).strip()
+
+    info = get_commit_info(tmp_path / 'repo')
+    assert (info.sha, info.branch, info.message) == (sha, 'main', 'initial commit\n\n')
+
+    check_call(['git', '-C', tmp_path / 'repo', 'checkout', '-q', '--detach'])
+    assert get_commit_info(tmp_path / 'repo').branch == 'HEAD'
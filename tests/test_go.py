@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+from territory import go
+
+
+def test_uim_cached(tmp_path, monkeypatch):
+    repo = tmp_path / 'repo'
+    (repo / 'pkg').mkdir(parents=True)
+    (repo / 'go.mod').write_text('module example.com/m\n')
+    (repo / 'pkg' / 'a.go').write_text('package pkg\n')
+    (repo / '.git').mkdir()
+    (repo / '.git' / 'b.go').write_text('package git\n')
+    runs = tmp_path / 'runs'
+    scanner = tmp_path / 'goscan'
+    scanner.write_text(
+        '#!/bin/sh\n'
+        f'echo run >> {runs}\n'
+        'mkdir -p "$2" && cat "$1/pkg/a.go" > "$2/nodes.uim" && echo search > "$2/search.uim"\n')
+    scanner.chmod(0o755)
+    monkeypatch.setenv('GOSCAN_PATH', str(scanner))
+
+    def scan(name):
+        package = SimpleNamespace(
+            temp_dir=tmp_path / name, repo_root=repo, cache_dir=tmp_path / 'cache', index_system=False)
+        lang = go.Lang()
+        lang.setup(package)
+        lang.prepare_package(package)
+        return (lang.uim_dir / 'nodes.uim').read_text()
+
+    assert go.find_sources(repo) == [repo / 'go.mod', repo / 'pkg' / 'a.go']
+    assert scan('first') == 'package pkg\n'
+    assert scan('second') == 'package pkg\n'
+    assert runs.read_text().count('run') == 1
+
+    (repo / 'pkg' / 'a.go').write_text('package pkg // changed\n')
+    assert scan('third') == 'package pkg // changed\n'
+    assert runs.read_text().count('run') == 2
@@ -0,0 +1,42 @@
+from subprocess import PIPE
+from threading import Thread
+import sys
+import time
+
+from territory import memory
+from territory.memory import Admission, run_measured
+
+
+def test_run_measured():
+    allocate = 'import sys; b = bytearray(64 << 20); sys.stderr.write("done"); sys.exit(3)'
+    completion, peak_rss = run_measured([sys.executable, '-c', allocate], stderr=PIPE, text=True)
+    assert completion.returncode == 3
+    assert completion.stderr == 'done'
+    assert peak_rss >= 64 << 20
+
+
+def test_run_measured_both_pipes():
+    # more output on both pipes than fits in a pipe buffer
+    chatty = 'import sys; sys.stdout.write("o" * (1 << 20)); sys.stderr.write("e" * (1 << 20))'
+    completion, _peak_rss = run_measured([sys.executable, '-c', chatty], stdout=PIPE, stderr=PIPE, text=True)
+    assert completion.returncode == 0
+    assert completion.stdout == 'o' * (1 << 20)
+    assert completion.stderr == 'e' * (1 << 20)
+
+
+def test_admission_backs_off(monkeypatch):
+    monkeypatch.setattr(memory, 'available_memory', lambda: 3 << 30)
+    admission = Admission(min_free=1 << 30)
+
+    # the first process is admitted no matter how large
+    admission.acquire(10 << 30)
+    admitted = []
+    waiting = Thread(target=lambda: admitted.append(admission.acquire(1 << 30)))
+    waiting.start()
+    time.sleep(0.2)
+    assert not admitted
+
+    admission.release(10 << 30)
+    waiting.join(5)
+    assert admitted
+    assert admission.waited >= 0.2
@@ -1,7 +1,8 @@
 from pathlib import Path
 import tarfile
 
-from territory.files import add_path_to_archive
+from territory import files
+from territory.files import Archiver, add_path_to_archive
 
 
 def test_symlink_directories_in_path(tmp_path):
@@ -113,3 +114,77 @@ def test_many_dotdots(tmp_path):
         mp = tmp_path
     assert (out / mp / 'd/f1').is_file()
     assert (out / mp / 'd/f2').is_file()
+
+
+def test_archiver(tmp_path):
+    (tmp_path / 'd/e').mkdir(parents=True)
+    (tmp_path / 'd/e/f').write_text('f')
+    (tmp_path / 'd/g').write_text('g')
+    (tmp_path / 'l').symlink_to('d/e', target_is_directory=True)
+    paths = [
+        tmp_path / 'd/e/f',
+        tmp_path / 'l/f',
+        tmp_path / 'd/e/../g',
+        tmp_path / 'missing',
+    ]
+
+    expected = tmp_path / 'expected.tar'
+    with tarfile.open(expected, 'w') as tar:
+        added = set()
+        for path in paths:
+            if path.exists():
+                add_path_to_archive(added, tar, path)
+
+    actual = tmp_path / 'actual.tar'
+    with tarfile.open(actual, 'w') as tar:
+        archiver = Archiver(tar, max_pending=1, batch_size=1)
+        archiver.add(paths[:2])
+        archiver.add(paths[2:])
+        archiver.close()
+
+    with tarfile.open(expected) as e, tarfile.open(actual) as a:
+        assert a.getnames() == e.getnames()
+
+
+def test_links_shared_between_calls(tmp_path, monkeypatch):
+    (tmp_path / 'd/e').mkdir(parents=True)
+    (tmp_path / 'd/e/f').write_text('f')
+    (tmp_path / 'd/e/g').write_text('g')
+    (tmp_path / 'l').symlink_to('d', target_is_directory=True)
+
+    lstats = []
+    real_lstat = files.lstat
+    monkeypatch.setattr(files, 'lstat', lambda p: lstats.append(p) or real_lstat(p))
+
+    added = set()
+    links = {}
+    with tarfile.open(tmp_path / 'out.tar', 'w') as tar:
+        add_path_to_archive(added, tar, tmp_path / 'l/e/f', links=links)
+        add_path_to_archive(added, tar, tmp_path / 'l/e/g', links=links)
+        add_path_to_archive(added, tar, tmp_path / 'd/e/../e/f', links=links)
+
+    assert len(lstats) == len(set(lstats))
+    assert links[str(tmp_path / 'l')] == 'd'
+    with tarfile.open(tmp_path / 'out.tar') as tar:
+        names = tar.getnames()
+    root = str(tmp_path).lstrip('/')
+    assert sorted(names) == sorted(set(names))
+    assert {f'{root}/l', f'{root}/d/e/f', f'{root}/d/e/g'} <= set(names)
+
+
+def test_archiver_deferred_order(tmp_path):
+    for name in ['b/y.h', 'b/x.c', 'a/z.h', 'b/w.h']:
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text(name)
+
+    with tarfile.open(tmp_path / 'out.tar', 'w') as tar:
+        archiver = Archiver(tar)
+        archiver.add([tmp_path / 'b/y.h'])
+        archiver.defer([tmp_path / 'b/w.h', tmp_path / 'b/y.h'])
+        archiver.defer([tmp_path / 'b/x.c', tmp_path / 'a/z.h'])
+        archiver.close()
+
+    with tarfile.open(tmp_path / 'out.tar') as tar:
+        names = [n for n in tar.getnames() if n.endswith(('.c', '.h'))]
+    root = str(tmp_path).lstrip('/')
+    assert names == [f'{root}/b/y.h', f'{root}/a/z.h', f'{root}/b/x.c', f'{root}/b/w.h']
@@ -0,0 +1,34 @@
+from pathlib import Path
+
+from territory.paths import PathSet, PathTable, pack_paths, unpack_paths
+
+
+def test_path_table():
+    table = PathTable()
+    ids = table.intern_all(['/src/a.h', '/src/b.h', Path('/src/a.h'), '/x', 'rel/c.h'])
+    assert ids == [0, 1, 0, 2, 3]
+    assert len(table) == 4
+    assert [table.name(i) for i in range(4)] == ['/src/a.h', '/src/b.h', '/x', 'rel/c.h']
+    assert table.path(0) == Path('/src/a.h')
+    assert table.find('/src/c.h') is None
+    assert table.find('/src/b.h') == 1
+
+
+def test_path_set():
+    table = PathTable()
+    paths = PathSet(table, ['/src/a.h', '/src/b.h'])
+    assert paths.update([Path('/src/b.h'), '/src/c.h', '/src/c.h']) == ['/src/c.h']
+    assert len(paths) == 3
+    assert Path('/src/a.h') in paths
+    assert '/src/d.h' not in paths
+    assert paths == {Path('/src/a.h'), Path('/src/b.h'), Path('/src/c.h')}
+
+    other = PathSet(table, ['/src/b.h', '/src/d.h'])
+    assert set(paths - other) == {Path('/src/a.h'), Path('/src/c.h')}
+    assert paths == PathSet(table, ['/src/c.h', '/src/b.h', '/src/a.h'])
+
+
+def test_pack_paths():
+    paths = ['/src/a b.h', '/src/\udcff.h']
+    assert unpack_paths(pack_paths(paths)) == paths
+    assert unpack_paths(pack_paths([])) == []
@@ -0,0 +1,60 @@
+from territory import python
+from territory.python import SHARD_SIZE, find_modules, plan_shards, scan_modules
+from territory.uim import UimCache
+
+
+def make_repo(root, packages, modules):
+    for p in range(packages):
+        for n in range(modules):
+            module = root / f'pkg{p}' / f'mod{n}.py'
+            module.parent.mkdir(parents=True, exist_ok=True)
+            other = (p + 1) % packages
+            module.write_text(
+                f'from pkg{other}.mod0 import f\n\n'
+                f'def f(a):\n    return a + {n}\n')
+
+
+def test_plan_shards(tmp_path):
+    make_repo(tmp_path, 3, 2)
+    make_repo(tmp_path / 'pkg0', 1, SHARD_SIZE + 1)
+
+    shards = plan_shards(find_modules(tmp_path))
+
+    assert [len(s) for s in shards] == [2, SHARD_SIZE, 1, 2, 2]
+    assert all(len({m.parent for m in s}) == 1 for s in shards)
+    assert plan_shards(reversed(find_modules(tmp_path))) == shards
+
+
+def test_scan_modules(tmp_path):
+    repo = tmp_path / 'repo'
+    make_repo(repo, 4, 3)
+
+    scan_modules(repo, tmp_path / 'serial', False, 1)
+    scan_modules(repo, tmp_path / 'parallel', False, 3)
+
+    for name in python.UIM_FILES:
+        serial = (tmp_path / 'serial' / name).read_bytes()
+        assert serial
+        assert (tmp_path / 'parallel' / name).read_bytes() == serial
+    assert all(str(repo / f'pkg{p}' / 'mod2.py').encode() in serial for p in range(4))
+    assert sorted(p.name for p in (tmp_path / 'parallel').iterdir()) == ['nodes.uim', 'search.uim']
+
+
+def test_scan_modules_cached(tmp_path, capsys):
+    repo = tmp_path / 'repo'
+    make_repo(repo, 4, 3)
+    cache = UimCache(tmp_path / 'cache', repo)
+
+    scan_modules(repo, tmp_path / 'first', False, 1, cache)
+    scan_modules(repo, tmp_path / 'second', False, 1, cache)
+    assert '4 of 4 shards unchanged' in capsys.readouterr().out
+    for name in python.UIM_FILES:
+        assert (tmp_path / 'second' / name).read_bytes() == (tmp_path / 'first' / name).read_bytes()
+
+    # pkg0 refers to pkg1/mod0.py, so both are scanned again
+    (repo / 'pkg1' / 'mod0.py').write_text('\n\ndef f(a):\n    return a\n')
+    scan_modules(repo, tmp_path / 'third', False, 1, cache)
+    assert '2 of 4 shards unchanged' in capsys.readouterr().out
+    scan_modules(repo, tmp_path / 'fresh', False, 1)
+    for name in python.UIM_FILES:
+        assert (tmp_path / 'third' / name).read_bytes() == (tmp_path / 'fresh' / name).read_bytes()
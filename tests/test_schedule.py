@@ -0,0 +1,30 @@
+from territory.cache import Cache
+from territory.schedule import BATCH_SECONDS, JobHistory, plan_batches
+
+
+def test_plan_batches():
+    expected = {'a': 0.1, 'b': 5.0, 'c': 0.2, 'd': 1.0, 'e': 0.3, 'f': 0.05}
+    batches = plan_batches(expected, expected.get, target=0.5)
+    assert batches == [['b'], ['d'], ['e', 'c'], ['a', 'f']]
+
+
+def test_history(tmp_path):
+    cache = Cache(tmp_path)
+    history = JobHistory(cache, 'scope')
+    assert history.expected('a.c') == BATCH_SECONDS
+    assert history.default_procs([8, 4]) == 8
+    assert history.expected_rss('a.c') == 0
+    history.record('a.c', 2.0, 100)
+    history.record('b.c', 4.0, 300)
+    history.record_throughput(8, 100, 10.0)
+    history.save()
+
+    history = JobHistory(cache, 'scope')
+    assert history.expected('a.c') == 2.0
+    assert history.expected('new.c') == 3.0
+    assert history.expected_rss('a.c') == 100
+    assert history.expected_rss('new.c') == 300
+    assert history.default_procs([8, 4]) == 4
+    history.record_throughput(4, 100, 5.0)
+    assert history.default_procs([8, 4]) == 4
+    assert JobHistory(cache, 'other').expected('a.c') == BATCH_SECONDS